@@ -0,0 +1,262 @@
+import collections
+import contextlib
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import metrics
+from ids import message_time
+from message import Message
+from search import matches, tokenize
+
+# Messages older than this many days leave the hot store for compressed
+# monthly partitions; 0 keeps everything hot.
+RETENTION_DAYS = float(os.environ.get("CHAT_RETENTION_DAYS", "90"))
+RETENTION_INTERVAL = 3600
+CACHE_PARTITIONS = 8
+
+logger = logging.getLogger("chat.archive")
+
+
+def partition_of(message_id):
+    return time.strftime("%Y-%m", time.gmtime(message_time(message_id)))
+
+
+def cutoff_id(days):
+    # Ids start with their creation time in hex, so every message older than
+    # `days` has an id that sorts below this one.
+    return f"{time.time_ns() - int(days * 86400e9):016x}"
+
+
+class ColdArchive:
+    # One gzip file of JSON messages per room and month, sorted by id. Files
+    # are only read when someone pages or searches that far back, and a few
+    # recently used partitions are kept decoded. The cache is checked against
+    # the files, so processes sharing a directory see each other's writes,
+    # and every read-modify-write holds a per-room file lock as well as the
+    # in-process one.
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.cache = collections.OrderedDict()  # (room, partition) -> (mtime, [Message])
+        self.listing = {}  # room -> (directory mtime, sorted partitions)
+
+    def _dir(self, room):
+        return os.path.join(self.root, hashlib.sha1(room.encode("utf-8")).hexdigest()[:20])
+
+    def _path(self, room, partition):
+        return os.path.join(self._dir(room), partition + ".json.gz")
+
+    @contextlib.contextmanager
+    def _locked(self, room):
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self._dir(room), exist_ok=True)
+            with open(os.path.join(self._dir(room), ".lock"), "w") as handle:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+                yield
+
+    def partitions(self, room):
+        try:
+            mtime = os.stat(self._dir(room)).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        with self.lock:
+            cached = self.listing.get(room)
+            if cached is None or cached[0] != mtime:
+                names = sorted(name[:-8] for name in os.listdir(self._dir(room)) if name.endswith(".json.gz"))
+                cached = self.listing[room] = (mtime, names)
+            return cached[1]
+
+    def load(self, room, partition):
+        path = self._path(room, partition)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return []
+        # Every write replaces the file, so the inode changes even if two
+        # writes land within one mtime tick.
+        mtime = (stat.st_mtime_ns, stat.st_ino)
+        with self.lock:
+            cached = self.cache.get((room, partition))
+            if cached is not None and cached[0] == mtime:
+                self.cache.move_to_end((room, partition))
+                return cached[1]
+            with metrics.span("archive_load"), gzip.open(path, "rt", encoding="utf-8") as file:
+                messages = [Message.from_dict(msg) for msg in json.load(file)]
+            self.cache[(room, partition)] = (mtime, messages)
+            if len(self.cache) > CACHE_PARTITIONS:
+                self.cache.popitem(last=False)
+            return messages
+
+    def _write(self, room, partition, messages):
+        path = self._path(room, partition)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8", compresslevel=9) as file:
+                json.dump([message.to_dict() for message in messages], file)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.cache.pop((room, partition), None)
+
+    def add(self, room, messages):
+        # Merged by id, so archiving the same message twice (after a crash
+        # between writing here and dropping it from the hot store) is harmless.
+        groups = {}
+        for message in messages:
+            groups.setdefault(partition_of(message.id), []).append(message)
+        with self._locked(room):
+            for partition, group in groups.items():
+                merged = {message.id: message for message in self.load(room, partition)}
+                merged.update((message.id, message.copy()) for message in group)
+                self._write(room, partition, sorted(merged.values(), key=lambda message: message.id))
+        metrics.count("messages_archived", len(messages))
+
+    def get(self, room, message_id):
+        partition = partition_of(message_id)
+        if partition not in self.partitions(room):
+            return None
+        found = next((message for message in self.load(room, partition) if message.id == message_id), None)
+        return found.copy() if found is not None else None
+
+    def change(self, room, message_id, fn):
+        # Applies fn to an archived message and rewrites its partition;
+        # returns fn's result, or None if the message is not archived.
+        partition = partition_of(message_id)
+        if partition not in self.partitions(room):
+            return None
+        with self._locked(room):
+            messages = [message.copy() for message in self.load(room, partition)]
+            target = next((message for message in messages if message.id == message_id), None)
+            if target is None:
+                return None
+            result = fn(target)
+            self._write(room, partition, messages)
+            return result
+
+    def update(self, room, message_id, fields):
+        def apply(message):
+            for field, value in fields.items():
+                setattr(message, field, value)
+        self.change(room, message_id, apply)
+
+    def delete(self, room, message_id):
+        partition = partition_of(message_id)
+        if partition not in self.partitions(room):
+            return False
+        with self._locked(room):
+            messages = self.load(room, partition)
+            kept = [message for message in messages if message.id != message_id]
+            if len(kept) == len(messages):
+                return False
+            if kept:
+                self._write(room, partition, kept)
+            else:
+                os.remove(self._path(room, partition))
+                self.cache.pop((room, partition), None)
+            return True
+
+    def remove_room(self, room):
+        with self._locked(room):
+            shutil.rmtree(self._dir(room), ignore_errors=True)
+            self.listing.pop(room, None)
+            for key in [key for key in self.cache if key[0] == room]:
+                del self.cache[key]
+
+    def older(self, room, before, limit):
+        # Up to `limit` archived messages with ids below `before` (all of
+        # them if None), oldest first. Walks partitions newest first and
+        # stops as soon as it has enough. Like every read here it returns
+        # copies, since the decoded partitions are shared by all sessions.
+        found = []
+        for partition in reversed(self.partitions(room)):
+            if before is not None and partition > partition_of(before):
+                continue
+            messages = self.load(room, partition)
+            if before is not None:
+                messages = [message for message in messages if message.id < before]
+            found[0:0] = messages[-(limit - len(found)):]
+            if len(found) >= limit:
+                break
+        return [message.copy() for message in found]
+
+    def newer(self, room, after, limit):
+        found = []
+        for partition in self.partitions(room):
+            if partition < partition_of(after):
+                continue
+            found.extend(message for message in self.load(room, partition) if message.id > after)
+            if len(found) >= limit:
+                break
+        return [message.copy() for message in found[:limit]]
+
+    def iter_messages(self, room):
+        for partition in self.partitions(room):
+            yield from (message.copy() for message in self.load(room, partition))
+
+    def search(self, query, rooms, limit=None):
+        # A scan rather than an index: archives are searched only on request.
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+        hits = []
+        with metrics.span("archive_search"):
+            for room in rooms:
+                for partition in self.partitions(room):
+                    hits.extend(message.copy() for message in self.load(room, partition) if matches(tokens, message))
+        hits.sort(key=lambda message: message.id, reverse=True)
+        return hits[:limit]
+
+
+def page(archive, room, hot, before, after, limit, anchored):
+    # Extends a page of hot (id, Message) pairs with archived messages. The
+    # archive always holds the older end of a room, so it fills in below the
+    # hot page, or serves the page when the anchor id is itself archived.
+    if limit is None or not archive.partitions(room):
+        return hot
+    if after is not None:
+        if anchored:
+            return hot
+        cold = [(message.id, message) for message in archive.newer(room, after, limit)]
+        return (cold + hot)[:limit]
+    if len(hot) >= limit:
+        return hot
+    bound = hot[0][0] if hot else before
+    return [(message.id, message) for message in archive.older(room, bound, limit - len(hot))] + hot
+
+
+def start_retention(store, days=RETENTION_DAYS, interval=RETENTION_INTERVAL):
+    # Archives once straight away, which also finishes a pass that a crash
+    # interrupted, then once per interval.
+    if days <= 0:
+        return
+
+    def run():
+        while True:
+            # A failed pass (another process holding the database, a full
+            # disk) is retried next interval instead of ending the thread.
+            try:
+                store.enforce_retention(days)
+            except Exception:
+                metrics.count("retention_errors")
+                logger.exception("retention pass failed")
+            time.sleep(interval)
+
+    threading.Thread(target=run, daemon=True, name="chat-retention").start()
@@ -0,0 +1,165 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import events
+import metrics
+
+QUEUE_LIMIT = 256
+# Steps tried in order when a session's queue is full:
+#   coalesce       merge an edit/reaction into the queued one for the same target
+#   drop_presence  drop join notices, the new one or the oldest queued one
+#   resync         throw the queue away and have the session reload its room
+OVERFLOW_POLICY = tuple(os.environ.get("CHAT_OVERFLOW", "coalesce,drop_presence,resync").split(","))
+ROOM_RATE = float(os.environ.get("CHAT_ROOM_RATE", "20"))  # messages per second per room; 0 disables
+ROOM_BURST = 40
+
+logger = logging.getLogger("chat.outbox")
+
+
+def coalesce_key(event):
+    if event.kind == events.MESSAGE_EDITED:
+        return (event.kind, event.message_id)
+    if event.kind == events.REACTION_TOGGLED:
+        # Only the last toggle matters: apply_reaction takes the final state.
+        return (event.kind, event.message_id, event.fields["emoji"], event.fields["user_name"])
+    if event.kind == events.ROOM_UPDATED:
+        # The newest summary covers the older ones; see merge() for the counts.
+        return (event.kind, event.room)
+    return None
+
+
+def merge(queued, event):
+    # The event that replaces a queued one with the same coalesce key. Room
+    # updates add up their message counts; events are shared between
+    # sessions, so a new one is built rather than either being changed.
+    if event.kind == events.ROOM_UPDATED:
+        return events.room_updated(event.room, event.fields["summary"], queued.fields["added"] + event.fields["added"])
+    return event
+
+
+def is_presence(event):
+    return event.kind == events.MESSAGE_ADDED and event.fields["message"].message_type == "login_message"
+
+
+class Outbox:
+    # Bounded queue between pubsub delivery and one session's UI handler.
+    # put() never blocks the publisher; a thread per session drains the
+    # queue, so a slow client only ever holds up itself.
+    def __init__(self, on_event, on_resync, limit=QUEUE_LIMIT, policy=OVERFLOW_POLICY):
+        self.on_event = on_event
+        self.on_resync = on_resync
+        self.limit = limit
+        self.policy = policy
+        self.ready = threading.Condition()
+        self.queue = collections.deque()  # [event] slots, so coalescing can swap one in place
+        self.keyed = {}  # coalesce key -> queued slot
+        self.resync = False
+        self.closed = False
+        threading.Thread(target=self.run, daemon=True, name="session-outbox").start()
+
+    def put(self, event):
+        with self.ready:
+            if self.closed or self.resync:
+                return
+            key = coalesce_key(event) if "coalesce" in self.policy else None
+            if key is not None and key in self.keyed:
+                self.keyed[key][0] = merge(self.keyed[key][0], event)
+                metrics.count("outbox_coalesced")
+                return
+            if len(self.queue) >= self.limit and not self.make_room(event):
+                return
+            slot = [event]
+            self.queue.append(slot)
+            if key is not None:
+                self.keyed[key] = slot
+            self.ready.notify()
+
+    def make_room(self, event):
+        # Returns whether the new event should still be queued.
+        if "drop_presence" in self.policy:
+            if is_presence(event):
+                metrics.count("outbox_dropped")
+                return False
+            for slot in self.queue:
+                if is_presence(slot[0]):
+                    self.queue.remove(slot)
+                    metrics.count("outbox_dropped")
+                    return True
+        if "resync" in self.policy:
+            self.queue.clear()
+            self.keyed.clear()
+            self.resync = True
+            metrics.count("outbox_resyncs")
+            self.ready.notify()
+            return False
+        # No policy freed a slot: the oldest event gives way.
+        slot = self.queue.popleft()
+        self.keyed.pop(coalesce_key(slot[0]), None)
+        metrics.count("outbox_dropped")
+        return True
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not (self.queue or self.resync or self.closed):
+                    self.ready.wait()
+                if self.closed:
+                    return
+                if self.resync:
+                    self.resync = False
+                    event = None
+                else:
+                    event = self.queue.popleft()[0]
+                    self.keyed.pop(coalesce_key(event), None)
+            # This is the session's only delivery thread: a handler that
+            # fails (a locked database, a control already gone) costs that
+            # one event, not every event after it.
+            try:
+                if event is None:
+                    self.on_resync()
+                else:
+                    self.on_event(event)
+            except Exception:
+                metrics.count("outbox_errors")
+                logger.exception("delivering %s failed", "resync" if event is None else event.kind)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.queue.clear()
+            self.keyed.clear()
+            self.ready.notify()
+
+
+class RateLimited(Exception):
+    pass
+
+
+class RoomRateLimiter:
+    # Token bucket per room, shared by every session in the process.
+    def __init__(self, rate=ROOM_RATE, burst=ROOM_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}  # room -> [tokens, last refill]
+
+    def check(self, room):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(room)
+            if bucket is None:
+                bucket = self.buckets[room] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                metrics.count("rate_limited")
+                raise RateLimited(f"Too many messages in {room}, slow down.")
+            bucket[0] -= 1
+
+
+room_limiter = RoomRateLimiter()
@@ -0,0 +1,314 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import backpressure
+import blobs
+import events
+import metrics
+import storage
+from chat import ChatSession, LocalPubSub
+
+WORDS = (
+    "hello world room chat message flet python storage search index journal segment "
+    "reaction emoji picture file upload session page latency benchmark coffee lunch "
+    "meeting tomorrow today release deploy review merge branch ticket weekend"
+).split()
+EMOJIS = ("👍", "❤️", "😂", "😮", "😢", "🎉")
+ATTACHMENT_SIZE = 32 * 1024
+
+# Relative weights of what a simulated user does on each step.
+OPERATIONS = {
+    "send": 60,
+    "react": 15,
+    "edit": 5,
+    "delete": 2,
+    "search": 8,
+    "select_room": 8,
+    "attach": 2,
+}
+
+
+class Timings:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, name, seconds):
+        self.samples.setdefault(name, []).append(seconds)
+
+    def measure(self, name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.add(name, time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        return {
+            name: {
+                "count": len(samples),
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": max(samples) * 1000,
+            }
+            for name, samples in sorted(self.samples.items())
+        }
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+class TimedPubSub(LocalPubSub):
+    # Records how long one publish takes to reach every subscriber of the
+    # room, which is the fan-out cost a sender pays.
+    def __init__(self, timings):
+        super().__init__()
+        self.timings = timings
+
+    def send_all_on_topic(self, topic, message):
+        self.timings.measure("fan_out", super().send_all_on_topic, topic, message)
+
+
+class FakeView:
+    # Stands in for a session's rendered history: keeps the messages it was
+    # told about and applies events to them the way the UI patches controls.
+    def __init__(self):
+        self.messages = {}
+        self.events = 0
+
+    def show(self, page):
+        self.messages = {message_id: message for message_id, message in page}
+
+    def on_event(self, event):
+        self.events += 1
+        if event.kind == events.MESSAGE_ADDED:
+            self.messages[event.message_id] = event.fields["message"].copy()
+            return
+        message = self.messages.get(event.message_id)
+        if message is None:
+            return
+        if event.kind == events.MESSAGE_EDITED:
+            message.text = event.fields["text"]
+        elif event.kind == events.REACTION_TOGGLED:
+            if event.fields["added"]:
+                message.add_reaction(event.fields["emoji"], event.fields["user_name"])
+            else:
+                message.remove_reaction(event.fields["emoji"], event.fields["user_name"])
+        elif event.kind == events.MESSAGE_DELETED:
+            del self.messages[event.message_id]
+
+
+def open_store(kind):
+    if kind == "sqlite":
+        from sqlite_storage import SqliteBackend
+        return SqliteBackend()
+    return storage.JsonBackend()
+
+
+def sentence(rng, words=8):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, words)))
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def io_written():
+    try:
+        with open("/proc/self/io") as file:
+            return dict(line.split(": ") for line in file.read().splitlines()).get("wchar")
+    except OSError:
+        return None
+
+
+def seed_rooms(store, rooms, history, rng):
+    session = ChatSession(store, LocalPubSub().client(), lambda event: None, "seed")
+    for room in rooms:
+        store.create_room(room)
+        session.open_room(room)
+        for _ in range(history):
+            session.user_name = f"user{rng.randrange(50)}"
+            store.add_message(room, session.new_message(sentence(rng)))
+    session.leave()
+    store.flush()
+
+
+def simulate(store, sessions, rooms, steps, rng, timings, workdir):
+    hub = TimedPubSub(timings)
+    attachment = os.path.join(workdir, "attachment.bin")
+    with open(attachment, "wb") as file:
+        file.write(bytes(rng.getrandbits(8) for _ in range(ATTACHMENT_SIZE)))
+
+    users = []
+    for index in range(sessions):
+        view = FakeView()
+        session = ChatSession(store, hub.client(), view.on_event, f"user{index}")
+        session.open_room(rooms[index % len(rooms)])
+        view.show(session.latest(session.room))
+        users.append((session, view))
+
+    names, weights = zip(*OPERATIONS.items())
+    for step in range(steps):
+        session, view = users[step % len(users)]
+        operation = rng.choices(names, weights)[0]
+        try:
+            perform(operation, session, view, rooms, rng, timings, attachment, step)
+        except backpressure.RateLimited:
+            timings.add("rate_limited", 0.0)
+        if step % 100 == 99:
+            timings.measure("flush", store.flush)
+    return sum(view.events for _, view in users)
+
+
+def perform(operation, session, view, rooms, rng, timings, attachment, step):
+    own = [m for m in view.messages.values() if m.user_name == session.user_name]
+    chat = [m for m in view.messages.values() if m.message_type == "chat_message"]
+    if operation == "send":
+        timings.measure("send", session.send, session.new_message(sentence(rng, 20)))
+    elif operation == "attach":
+        timings.measure("attach", session.attach, session.new_message(""), attachment, f"file{step}.bin")
+    elif operation == "react" and chat:
+        timings.measure("react", session.react, rng.choice(chat), rng.choice(EMOJIS))
+    elif operation == "edit" and own:
+        timings.measure("edit", session.edit, rng.choice(own), sentence(rng))
+    elif operation == "delete" and own:
+        timings.measure("delete", session.delete, rng.choice(own))
+    elif operation == "search":
+        timings.measure("perform_search", session.search, rng.choice(WORDS)[:4], all_rooms=rng.random() < 0.2)
+    elif operation == "select_room":
+        start = time.perf_counter()
+        session.open_room(rng.choice(rooms))
+        view.show(session.latest(session.room))
+        timings.add("select_room", time.perf_counter() - start)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    timings = Timings()
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    cwd = os.getcwd()
+    # Every path the stores use is relative to the working directory, apart
+    # from the blob store, which is pointed into the scratch directory too.
+    os.chdir(workdir)
+    blobs.BLOB_DIR = os.path.join(workdir, "blobs")
+    try:
+        store = open_store(args.backend)
+        rooms = [f"room{index}" for index in range(args.rooms)]
+        seed_rooms(store, rooms, args.history, rng)
+        seeded_bytes = disk_usage(workdir)
+        written_before = io_written()
+
+        start = time.perf_counter()
+        delivered = simulate(store, args.sessions, rooms, args.steps, rng, timings, workdir)
+        timings.measure("flush", store.flush)
+        elapsed = time.perf_counter() - start
+        if args.backend == "json":
+            storage.compact()
+
+        written_after = io_written()
+        report = {
+            "config": vars(args),
+            "elapsed_s": elapsed,
+            "events_delivered": delivered,
+            "operations": timings.summary(),
+            "peak_rss_bytes": peak_rss(),
+            # Net growth of the data directory, not bytes written: compaction
+            # gzips the seeding journal, so on the JSON store it can be negative.
+            "disk_delta_bytes": disk_usage(workdir) - seeded_bytes,
+            "io_written_bytes": (
+                int(written_after) - int(written_before) if written_before and written_after else None
+            ),
+        }
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def print_report(report):
+    config = report["config"]
+    print(
+        f"{config['backend']}: {config['sessions']} sessions, {config['rooms']} rooms, "
+        f"{config['steps']} steps, seed {config['seed']} ({report['elapsed_s']:.2f}s)"
+    )
+    print(f"{'operation':<16}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in report["operations"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+    print(f"events delivered: {report['events_delivered']}")
+    if report["peak_rss_bytes"] is not None:
+        print(f"peak RSS: {report['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+    print(f"disk size change: {report['disk_delta_bytes']:+d} bytes")
+    if report["io_written_bytes"] is not None:
+        print(f"bytes written: {report['io_written_bytes']}")
+
+
+def regressions(report, baseline, tolerance):
+    found = []
+    for name, stats in report["operations"].items():
+        before = baseline["operations"].get(name)
+        if before and stats["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            found.append(f"{name}: p99 {before['p99_ms']:.3f} -> {stats['p99_ms']:.3f} ms")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated chat load against the storage and pubsub core.")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--history", type=int, default=500, help="messages per room before the run")
+    parser.add_argument("--steps", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--room-rate", type=float, default=0, help="per-room message rate limit; 0 disables")
+    parser.add_argument("--json", metavar="FILE", help="also write the report as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="fail if a p99 regressed against this JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--keep", action="store_true", help="keep the scratch data directory")
+    parser.add_argument("--metrics", metavar="FILE", help="enable instrumentation and export it (.prom or .json)")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+    backpressure.room_limiter.rate = args.room_rate
+    report = run(args)
+    print_report(report)
+    if args.metrics:
+        metrics.export(args.metrics)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            found = regressions(report, json.load(file), args.tolerance)
+        for line in found:
+            print(f"regression: {line}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
+BLOB_DIR = os.path.join(ASSETS_DIR, "blobs")
+CHUNK_SIZE = 64 * 1024
+# Longest side in pixels. The timeline uses TIMELINE_THUMB; the others are
+# there for denser or high-DPI layouts.
+THUMB_SIZES = (160, 320, 640)
+TIMELINE_THUMB = 320
+
+
+def blob_path(sha256):
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+
+def blob_url(sha256):
+    # Relative to ASSETS_DIR, which the app serves as its assets directory.
+    return f"/blobs/{sha256[:2]}/{sha256}"
+
+
+def thumb_path(sha256, size):
+    return os.path.join(BLOB_DIR, "thumbs", str(size), sha256[:2], sha256 + ".webp")
+
+
+def thumb_url(sha256, size):
+    return f"/blobs/thumbs/{size}/{sha256[:2]}/{sha256}.webp"
+
+
+def is_image(attachment):
+    return attachment["mime"].startswith("image/")
+
+
+def format_size(size):
+    if size < 1024:
+        return f"{size} B"
+    for unit in ("KB", "MB", "GB"):
+        size /= 1024
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+
+
+def make_thumbnails(sha256):
+    # Returns the fields to merge into an image attachment: its dimensions
+    # and the thumbnail sizes that exist. Thumbnails are keyed by the blob
+    # hash, so an image uploaded twice is only scaled once. Pillow is
+    # imported here rather than at the top: it is optional (without it images
+    # show from the original blob) and slow to import, and only uploads need it.
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return {}
+    try:
+        with Image.open(blob_path(sha256)) as image:
+            image = ImageOps.exif_transpose(image)
+            width, height = image.size
+            sizes = []
+            for size in THUMB_SIZES:
+                path = thumb_path(sha256, size)
+                if not os.path.exists(path):
+                    if max(width, height) <= size and sizes:
+                        break
+                    thumb = image.copy()
+                    thumb.thumbnail((size, size))
+                    if thumb.mode not in ("RGB", "RGBA"):
+                        thumb = thumb.convert("RGBA")
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                    with os.fdopen(fd, "wb") as out:
+                        thumb.save(out, "WEBP", quality=80)
+                    os.replace(tmp, path)
+                sizes.append(size)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return {}
+    return {"width": width, "height": height, "thumbs": sizes}
+
+
+def put_file(path, name=None, directory=None):
+    # Content-addressed: storing the same bytes twice keeps one file.
+    # `directory` defaults to BLOB_DIR; transfer.py points it at an export's
+    # blob directory, which has the same layout.
+    with open(path, "rb") as src:
+        return _put(iter(lambda: src.read(CHUNK_SIZE), b""), name or os.path.basename(path), directory)
+
+
+def put_bytes(data, name, directory=None):
+    return _put([data], name, directory)
+
+
+def _put(chunks, name, directory=None):
+    directory = directory or BLOB_DIR
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in chunks:
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+        target = os.path.join(directory, sha256[:2], sha256)
+        if os.path.exists(target):
+            os.remove(tmp)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return {
+        "sha256": sha256,
+        "size": size,
+        "mime": mimetypes.guess_type(name)[0] or "application/octet-stream",
+        "name": name,
+    }
@@ -0,0 +1,117 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from chat import LocalPubSub, LocalPubSubClient
+from events import Event
+
+# Set CHAT_BRIDGE=sqlite (together with CHAT_STORAGE=sqlite) to run several
+# app processes on one host against the same rooms.
+BRIDGE = os.environ.get("CHAT_BRIDGE")
+EVENTS_DB = "chat_events.db"
+POLL_INTERVAL = 0.02
+RETAIN_SECONDS = 300
+TRIM_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+class SqliteBus:
+    # Cross-process pubsub through an append-only SQLite table. A publish is
+    # only inserted; every process, the publisher included, then delivers
+    # rows to its own sessions strictly in seq order, so all processes see a
+    # room's events in the same order. Other processes notice new rows by
+    # polling PRAGMA data_version, which costs no table read while idle.
+    def __init__(self, path=EVENTS_DB, interval=POLL_INTERVAL):
+        self.hub = LocalPubSub()
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.drain_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        with self.db:
+            self.db.executescript(SCHEMA)
+        # Only events published from now on; nothing is replayed on start.
+        self.last = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+        self.version = None
+        self.closed = False
+        threading.Thread(target=self.run, daemon=True, name="pubsub-bridge").start()
+
+    def client(self):
+        return BusClient(self)
+
+    def publish(self, topic, event):
+        payload = json.dumps(event.to_dict())
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT INTO events(topic, payload, created) VALUES (?, ?, ?)", (topic, payload, time.time())
+            )
+        metrics.count("bridge_events_published")
+        self.drain()
+
+    def drain(self):
+        with self.drain_lock, metrics.span("bridge_drain"):
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT seq, topic, payload FROM events WHERE seq > ? ORDER BY seq", (self.last,)
+                ).fetchall()
+            for seq, topic, payload in rows:
+                self.last = seq
+                self.hub.send_all_on_topic(topic, Event.from_dict(json.loads(payload)))
+
+    def trim(self):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM events WHERE created < ?", (time.time() - RETAIN_SECONDS,))
+
+    def run(self):
+        polls = 0
+        while not self.closed:
+            time.sleep(self.interval)
+            with self.lock:
+                version = self.db.execute("PRAGMA data_version").fetchone()[0]
+            if version != self.version:
+                self.version = version
+                self.drain()
+            polls += 1
+            if polls % TRIM_EVERY == 0:
+                self.trim()
+
+    def close(self):
+        self.closed = True
+
+
+class BusClient(LocalPubSubClient):
+    # Same surface as a Flet page's pubsub. Subscriptions live in the local
+    # hub, and publishes go through the shared table.
+    def __init__(self, bus):
+        super().__init__(bus.hub)
+        self.bus = bus
+
+    def send_all_on_topic(self, topic, message):
+        self.bus.publish(topic, message)
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+
+def open_pubsub(page):
+    global _bus
+    if not BRIDGE:
+        return page.pubsub
+    if BRIDGE != "sqlite":
+        raise ValueError(f"Unknown pubsub bridge: {BRIDGE}")
+    with _bus_lock:
+        if _bus is None:
+            _bus = SqliteBus()
+    return _bus.client()
@@ -0,0 +1,260 @@
+import threading
+
+import events
+import metrics
+from backpressure import room_limiter
+from blobs import is_image, make_thumbnails, put_file
+from message import Message
+from search import search_service
+
+PAGE_SIZE = 50
+SEARCH_LIMIT = 100
+DIRECTORY_TOPIC = "rooms"
+DIRECTORY_INTERVAL = 0.5
+
+
+def room_topic(room):
+    return f"room:{room}"
+
+
+class LocalPubSub:
+    # In-process stand-in for a Flet page's pubsub with the same topic
+    # methods; handlers run synchronously in the sender's thread. Each
+    # session gets its own client() so unsubscribing only drops its handlers.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}  # topic -> {client: handler}
+
+    def client(self):
+        return LocalPubSubClient(self)
+
+    def send_all_on_topic(self, topic, message):
+        with self.lock:
+            handlers = list(self.subscribers.get(topic, {}).values())
+        for handler in handlers:
+            handler(topic, message)
+
+
+class LocalPubSubClient:
+    def __init__(self, hub):
+        self.hub = hub
+
+    def send_all_on_topic(self, topic, message):
+        self.hub.send_all_on_topic(topic, message)
+
+    def subscribe_topic(self, topic, handler):
+        with self.hub.lock:
+            self.hub.subscribers.setdefault(topic, {})[self] = handler
+
+    def unsubscribe_topic(self, topic):
+        with self.hub.lock:
+            self.hub.subscribers.get(topic, {}).pop(self, None)
+
+
+class DirectoryThrottle:
+    # Directory updates reach every connected session, so a busy room sends
+    # at most one per interval: the first straight away, the rest folded
+    # into a single trailing update that carries all their added messages.
+    # Shared by every session in the process, like room_limiter.
+    def __init__(self, interval=DIRECTORY_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.waiting = {}  # room -> [added, send or None] during its interval
+
+    def submit(self, room, added, send):
+        with self.lock:
+            pending = self.waiting.get(room)
+            if pending is not None:
+                pending[0] += added
+                pending[1] = send
+                metrics.count("directory_coalesced")
+                return
+            self.waiting[room] = [0, None]
+        timer = threading.Timer(self.interval, self.close_interval, (room,))
+        timer.daemon = True
+        timer.start()
+        send(added)
+
+    def close_interval(self, room):
+        with self.lock:
+            added, send = self.waiting.pop(room)
+        if send is not None:
+            self.submit(room, added, send)
+
+
+directory_throttle = DirectoryThrottle()
+
+
+class ChatSession:
+    # The room and message logic of one connected user, without any widgets:
+    # main() drives it from a Flet page and bench.py from LocalPubSub. Every
+    # method blocks on storage, so the UI calls them through run_blocking.
+    def __init__(self, store, pubsub, on_event, user_name=None):
+        self.store = store
+        self.pubsub = pubsub
+        self.on_event = on_event
+        self.user_name = user_name
+        self.room = None
+        self.watched_room = None
+        # room -> unread count as this session last knew it; kept up to date
+        # from room_updated events instead of storage reads.
+        self.unread = {}
+        self.unread_lock = threading.Lock()
+        self.searcher = search_service(store)
+        self.pubsub.subscribe_topic(DIRECTORY_TOPIC, self.deliver)
+
+    def publish(self, event):
+        metrics.count("events_published")
+        topic = DIRECTORY_TOPIC if event.kind in (events.ROOM_UPDATED, events.ROOM_DELETED) else room_topic(event.room)
+        with metrics.span("pubsub_publish"):
+            self.pubsub.send_all_on_topic(topic, event)
+
+    def deliver(self, topic, event):
+        metrics.count("events_delivered")
+        self.on_event(event)
+
+    def watch(self, room):
+        # Each session listens only to the room it has open, so a message
+        # reaches the viewers of its room rather than every connected session.
+        if room == self.watched_room:
+            return
+        if self.watched_room is not None:
+            self.pubsub.unsubscribe_topic(room_topic(self.watched_room))
+        self.watched_room = room
+        if room is not None:
+            self.pubsub.subscribe_topic(room_topic(room), self.deliver)
+
+    def open_room(self, room):
+        # Read markers are written when a room is opened or left, not for
+        # every message that arrives while it is open.
+        if room != self.room:
+            self.mark_read()
+        self.room = room
+        self.watch(room)
+        if room is not None:
+            self.store.mark_read(room, self.user_name)
+            with self.unread_lock:
+                self.unread[room] = 0
+
+    def mark_read(self):
+        if self.room is not None and self.store.has_room(self.room):
+            self.store.mark_read(self.room, self.user_name)
+
+    def directory(self):
+        entries = self.store.directory(self.user_name)
+        with self.unread_lock:
+            for entry in entries:
+                if entry["room"] == self.room:
+                    entry["unread"] = 0
+                self.unread[entry["room"]] = entry["unread"]
+        return entries
+
+    def directory_entry(self, event):
+        # This session's entry for a room_updated event, from the event alone.
+        entry = dict(event.fields["summary"])
+        with self.unread_lock:
+            unread = 0 if event.room == self.room else self.unread.get(event.room, 0) + event.fields["added"]
+            entry["unread"] = self.unread[event.room] = max(0, min(unread, entry["count"]))
+        return entry
+
+    def room_updated(self, room, added=0):
+        # The summary is read when the update goes out, so a trailing one
+        # carries the room's state at the end of its interval.
+        def send(added):
+            summary = self.store.room_summary(room)
+            if summary is not None:
+                self.publish(events.room_updated(room, summary, added))
+        directory_throttle.submit(room, added, send)
+
+    def join(self, room, created=False):
+        if created:
+            self.store.create_room(room)
+            self.room_updated(room)
+        self.open_room(room)
+        action = "has created and joined" if created else "has joined"
+        self.publish(events.message_added(
+            Message(self.user_name, f"{self.user_name} {action} the room {room}.", "login_message", room)
+        ))
+
+    def leave(self):
+        self.room = None
+        self.watch(None)
+
+    def close(self):
+        self.mark_read()
+        self.leave()
+        self.pubsub.unsubscribe_topic(DIRECTORY_TOPIC)
+
+    def delete_room(self, room):
+        if not self.store.has_room(room):
+            return False
+        self.store.delete_room(room)
+        if self.room == room:
+            self.leave()
+        self.publish(events.room_deleted(room))
+        return True
+
+    def latest(self, room, limit=PAGE_SIZE):
+        return self.store.messages(room, limit=limit)
+
+    def older(self, room, before, limit=PAGE_SIZE):
+        return self.store.messages(room, before=before, limit=limit)
+
+    def newer(self, room, after, limit=PAGE_SIZE):
+        return self.store.messages(room, after=after, limit=limit)
+
+    def around(self, room, message_id, limit=PAGE_SIZE):
+        # Returns (older, target, newer), or None if the message is gone.
+        target = self.store.get_message(room, message_id)
+        if target is None:
+            return None
+        half = limit // 2
+        return (
+            self.store.messages(room, before=message_id, limit=half),
+            target,
+            self.store.messages(room, after=message_id, limit=half),
+        )
+
+    def new_message(self, text):
+        return Message(self.user_name, text, message_type="chat_message", room=self.room)
+
+    def send(self, message):
+        # Raises RateLimited when the room is being flooded.
+        room_limiter.check(message.room)
+        metrics.count("messages_sent")
+        self.store.add_message(message.room, message)
+        self.publish(events.message_added(message))
+        self.room_updated(message.room, added=1)
+        return message
+
+    def attach(self, message, path, name):
+        with metrics.span("blob_put_file"):
+            message.attachment = put_file(path, name)
+        if is_image(message.attachment):
+            with metrics.span("blob_thumbnails"):
+                message.attachment.update(make_thumbnails(message.attachment["sha256"]))
+        metrics.count("attachment_bytes", message.attachment["size"])
+        message.text = ""
+        return self.send(message)
+
+    def edit(self, message, text):
+        self.store.update_message(message.room, message.id, {"text": text})
+        self.publish(events.message_edited(message.room, message.id, text))
+
+    def delete(self, message):
+        self.store.delete_message(message.room, message.id)
+        self.publish(events.message_deleted(message.room, message.id))
+        self.room_updated(message.room)
+
+    def react(self, message, emoji):
+        added = self.store.toggle_reaction(message.room, message.id, emoji, self.user_name)
+        if added is not None:
+            self.publish(events.reaction_toggled(message.room, message.id, emoji, self.user_name, added))
+        return added
+
+    def search(self, query, all_rooms=False, limit=SEARCH_LIMIT, include_archive=False):
+        # Ranked SearchHits; a room: filter in the query overrides the scope.
+        room = None if all_rooms else self.room
+        if not query or not (room or all_rooms or "room:" in query):
+            return []
+        return self.searcher.search(query, room=room, limit=limit, include_archive=include_archive)
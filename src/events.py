@@ -0,0 +1,58 @@
+from message import Message
+
+MESSAGE_ADDED = "message_added"
+MESSAGE_EDITED = "message_edited"
+MESSAGE_DELETED = "message_deleted"
+REACTION_TOGGLED = "reaction_toggled"
+ROOM_UPDATED = "room_updated"
+ROOM_DELETED = "room_deleted"
+
+
+class Event:
+    def __init__(self, kind: str, room: str, message_id: str, **fields):
+        self.kind = kind
+        self.room = room
+        self.message_id = message_id
+        self.fields = fields
+
+    # Plain-data form for sending an event to another process.
+    def to_dict(self):
+        fields = dict(self.fields)
+        if "message" in fields:
+            fields["message"] = fields["message"].to_dict()
+        return {"kind": self.kind, "room": self.room, "message_id": self.message_id, "fields": fields}
+
+    @classmethod
+    def from_dict(cls, data):
+        fields = dict(data["fields"])
+        if "message" in fields:
+            fields["message"] = Message.from_dict(fields["message"])
+        return cls(data["kind"], data["room"], data["message_id"], **fields)
+
+
+def message_added(message):
+    return Event(MESSAGE_ADDED, message.room, message.id, message=message)
+
+
+def message_edited(room, message_id, text):
+    return Event(MESSAGE_EDITED, room, message_id, text=text)
+
+
+def message_deleted(room, message_id):
+    return Event(MESSAGE_DELETED, room, message_id)
+
+
+def reaction_toggled(room, message_id, emoji, user_name, added):
+    return Event(REACTION_TOGGLED, room, message_id, emoji=emoji, user_name=user_name, added=added)
+
+
+# Directory events are about a room rather than a message; every session
+# gets them on DIRECTORY_TOPIC. room_updated carries the room's summary and
+# how many messages were added, so sessions keep their own unread counts
+# without a storage read per event.
+def room_updated(room, summary, added=0):
+    return Event(ROOM_UPDATED, room, None, summary=summary, added=added)
+
+
+def room_deleted(room):
+    return Event(ROOM_DELETED, room, None)
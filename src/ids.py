@@ -0,0 +1,16 @@
+import os
+import time
+
+
+def new_message_id():
+    # Nanosecond timestamp first so ids sort by creation time; the random
+    # suffix keeps ids unique across sessions and processes.
+    return f"{time.time_ns():016x}{os.urandom(4).hex()}"
+
+
+def message_time(message_id):
+    # Seconds since the epoch encoded in a message id, or 0 if it has none.
+    try:
+        return int(message_id[:16], 16) / 1e9
+    except (TypeError, ValueError):
+        return 0
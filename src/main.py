@@ -1,10 +1,28 @@
+import startup
 import flet as ft
-import base64
-from storage import load_rooms, save_rooms
-from models import Message, ChatMessage
-
-def main(page: ft.Page):
-    rooms = load_rooms()
+from bridge import open_pubsub
+from backpressure import Outbox, RateLimited
+from chat import PAGE_SIZE, ChatSession
+from storage import open_backend
+from models import Message
+from widgets import ChatMessage, ImageViewer, LazyOverlay, MessageActions, RoomRow, search_result
+import events
+import metrics
+from scheduler import UpdateScheduler
+from workers import run_blocking
+
+startup.imports_done()
+
+MAX_RENDERED = 150
+LOAD_THRESHOLD = 200
+
+
+async def main(page: ft.Page):
+    timer = startup.SessionStartup()
+    # Room metadata is loaded once per process, by the first open_backend();
+    # later sessions start from the same in-memory state.
+    store = open_backend()
+    scheduler = UpdateScheduler(page)
     page.horizontal_alignment = ft.CrossAxisAlignment.STRETCH
     page.title = "Flet Chat with Rooms"
 
@@ -26,109 +44,273 @@ def main(page: ft.Page):
         on_click=toggle_theme,
     )
 
-    rooms = load_rooms()
-    current_room = page.session.get("room")
-    user_name = page.session.get("user_name")
-    room_title = ft.Text(f"Room: {current_room}" if current_room else "No room selected", size=18, weight="bold")
-    room_list = ft.Column(scroll=ft.ScrollMode.AUTO, width=220)
-    search_active = False
-
-    def update_room_list():
-        room_list.controls.clear()
-        for room in rooms.keys():
-            room_list.controls.append(
-                ft.Row(
-                    [
-                        ft.TextButton(room, on_click=lambda e, r=room: select_room(r)),
-                        ft.IconButton(
-                            icon=ft.icons.DELETE,
-                            tooltip="Delete room",
-                            on_click=lambda e, r=room: delete_room(r),
-                        ),
-                    ],
-                    alignment=ft.MainAxisAlignment.SPACE_BETWEEN,
-                )
+    # Events reach this session through its own bounded queue, so a slow
+    # client cannot hold up delivery to the others.
+    outbox = Outbox(lambda event: on_event(event), lambda: page.run_task(resync))
+    session = ChatSession(store, open_pubsub(page), outbox.put, page.session.get("user_name"))
+    await run_blocking(session.open_room, page.session.get("room"))
+    # Read once here; it both fills the room list and decides what the
+    # welcome dialog asks for.
+    directory = await run_blocking(session.directory)
+    timer.mark("load")
+
+    def on_close(e):
+        scheduler.close()
+        outbox.close()
+        # Bridge subscriptions are not tied to the page, so drop them here.
+        session.close()
+
+    page.on_close = on_close
+    room_title = ft.Text(f"Room: {session.room}" if session.room else "No room selected", size=18, weight="bold")
+    room_list = ft.ListView(expand=True, spacing=2)
+    room_rows = {}
+    rendered = {}
+    has_older = False
+    has_newer = False
+    loading = False
+
+    def room_row(room):
+        row = room_rows.get(room)
+        if row is None:
+            row = room_rows[room] = RoomRow(
+                room,
+                on_select=lambda r: page.run_task(select_room, r),
+                on_delete=lambda r: page.run_task(delete_room, r),
             )
-        room_list.update()
-
-    def select_room(room):
-        nonlocal current_room, search_active
-        current_room = room
-        search_active = False
-        page.session.set("room", current_room)
-        room_title.value = f"Room: {current_room}"
-        room_title.update()
-        chat_container.content = ft.ListView(expand=True, spacing=10, auto_scroll=True)
+        return row
+
+    # The sidebar is only changed from coroutines on the page's event loop,
+    # so directory events from the outbox thread never race a room switch.
+    async def update_room_list(entries=None):
+        # The full directory is only read once per join; after that rows are
+        # patched one at a time from directory events.
+        if entries is None:
+            entries = await run_blocking(session.directory)
+        room_list.controls[:] = [room_row(e["room"]).set_entry(e, e["room"] == session.room) for e in entries]
+        for room in set(room_rows) - {e["room"] for e in entries}:
+            del room_rows[room]
+        scheduler.schedule(room_list)
+
+    async def place_room(entry):
+        room = entry["room"]
+        row = room_row(room).set_entry(entry, room == session.room)
+        controls = room_list.controls
+        # Keep the list ordered by activity; only a move re-sends the list.
+        old = controls.index(row) if row in controls else None
+        if old is not None:
+            del controls[old]
+        index = next((i for i, other in enumerate(controls) if other.last_activity <= row.last_activity), len(controls))
+        controls.insert(index, row)
+        scheduler.schedule(row if index == old else room_list)
+
+    async def remove_room(room):
+        row = room_rows.pop(room, None)
+        if row is not None and row in room_list.controls:
+            room_list.controls.remove(row)
+            scheduler.schedule(room_list)
+
+    @metrics.timed("ui_select_room")
+    async def select_room(room, around=None):
+        previous = session.room
+        await run_blocking(session.open_room, room)
+        for name in {previous, room} - {None}:
+            # Both rooms were just marked read.
+            row = room_rows.get(name)
+            if row is not None and row.entry is not None:
+                scheduler.schedule(row.set_entry(dict(row.entry, unread=0), name == session.room))
+        page.session.set("room", session.room)
+        room_title.value = f"Room: {session.room}"
+        chat_container.content = new_history_view()
         
-        if current_room in rooms:
-            for message_data in rooms[current_room]:
-                message = Message(**message_data)
-                if message.message_type == "chat_message":
-                    m = ChatMessage(
-                        message, 
-                        on_edit=edit_message, 
-                        on_delete=delete_message,
-                        on_reaction=update_reactions,
-                        current_user=user_name,
-                        highlight=False
-                    )
-                elif message.message_type == "login_message":
-                    m = ft.Text(message.text, italic=True, color=ft.Colors.GREY_500, size=12)
-                chat_container.content.controls.append(m)
+        if store.has_room(session.room):
+            if around is not None:
+                await load_around(around)
+            else:
+                await load_latest()
         
-        page.update()
+        scheduler.schedule()
 
-    def update_reactions(message: Message):
-        for idx, msg_data in enumerate(rooms[message.room]):
-            if msg_data.get("text") == message.text and msg_data.get("user_name") == message.user_name:
-                rooms[message.room][idx]["reactions"] = message.reactions
-                break
-        save_rooms(rooms)
-
-    def delete_room(room):
-        if room in rooms:
-            del rooms[room]
-            save_rooms(rooms)
-            if current_room == room:
+    def new_history_view():
+        nonlocal has_older, has_newer
+        has_older = has_newer = False
+        rendered.clear()
+        return ft.ListView(
+            expand=True,
+            spacing=10,
+            auto_scroll=True,
+            on_scroll=on_history_scroll,
+            on_scroll_interval=100,
+        )
+
+    def render_message(message: Message, highlight=False, pending=False):
+        if message.message_type == "login_message":
+            return ft.Text(message.text, italic=True, color=ft.Colors.GREY_500, size=12)
+        m = ChatMessage(
+            message,
+            actions=message_actions,
+            on_reaction=toggle_reaction,
+            current_user=session.user_name,
+            highlight=highlight,
+            pending=pending,
+            viewer=image_viewer,
+        )
+        # Only stored chat messages carry a key, which is what paging and
+        # scroll_to go by.
+        m.key = message.id
+        rendered[message.id] = m
+        metrics.count("controls_rendered")
+        return m
+
+    def render_page(messages):
+        return [render_message(message) for _, message in messages]
+
+    def drop_controls(start, stop):
+        controls = chat_container.content.controls
+        for control in controls[start:stop]:
+            rendered.pop(control.key, None)
+        del controls[start:stop]
+
+    def history_bound(controls):
+        return next((c.key for c in controls if c.key is not None), None)
+
+    async def load_latest():
+        nonlocal has_older
+        messages = await run_blocking(session.latest, session.room)
+        rendered.clear()
+        chat_container.content.controls[:] = render_page(messages)
+        has_older = len(messages) == PAGE_SIZE
+
+    async def load_around(message_id):
+        nonlocal has_older, has_newer
+        found = await run_blocking(session.around, session.room, message_id)
+        if found is None:
+            await load_latest()
+            return
+        older, target, newer = found
+        half = PAGE_SIZE // 2
+        history = chat_container.content
+        rendered.clear()
+        history.controls[:] = render_page(older) + [render_message(target, highlight=True)] + render_page(newer)
+        has_older = len(older) == half
+        has_newer = len(newer) == half
+        history.auto_scroll = not has_newer
+
+    @metrics.timed("ui_load_older")
+    async def load_older():
+        nonlocal has_older, has_newer
+        history = chat_container.content
+        oldest = history_bound(history.controls)
+        if oldest is None:
+            return
+        messages = await run_blocking(session.older, session.room, oldest)
+        history.controls[0:0] = render_page(messages)
+        has_older = len(messages) == PAGE_SIZE
+        if len(history.controls) > MAX_RENDERED:
+            drop_controls(MAX_RENDERED, None)
+            has_newer = True
+        history.auto_scroll = False
+        scheduler.schedule(history)
+
+    @metrics.timed("ui_load_newer")
+    async def load_newer():
+        nonlocal has_older, has_newer
+        history = chat_container.content
+        newest = history_bound(reversed(history.controls))
+        if newest is None:
+            return
+        messages = await run_blocking(session.newer, session.room, newest)
+        history.controls.extend(render_page(messages))
+        has_newer = len(messages) == PAGE_SIZE
+        if len(history.controls) > MAX_RENDERED:
+            drop_controls(0, len(history.controls) - MAX_RENDERED)
+            has_older = True
+        history.auto_scroll = not has_newer
+        scheduler.schedule(history)
+
+    async def on_history_scroll(e: ft.OnScrollEvent):
+        nonlocal loading
+        if not session.room or loading:
+            return
+        loading = True
+        try:
+            if has_older and e.pixels <= e.min_scroll_extent + LOAD_THRESHOLD:
+                await load_older()
+            elif has_newer and e.pixels >= e.max_scroll_extent - LOAD_THRESHOLD:
+                await load_newer()
+        finally:
+            loading = False
+
+    async def resync():
+        # The outbox overflowed and dropped events: reload what is on screen.
+        await update_room_list()
+        if session.room is not None:
+            await select_room(session.room)
+
+    # Overlays are built on first use rather than with the page.
+    notice = LazyOverlay(page, lambda: ft.SnackBar(ft.Text("")))
+
+    def show_notice(text):
+        bar = notice.get()
+        bar.content.value = text
+        bar.open = True
+        bar.update()
+
+    def drop_pending(message: Message):
+        control = rendered.pop(message.id, None)
+        if control is not None and control in chat_container.content.controls:
+            chat_container.content.controls.remove(control)
+            scheduler.schedule(chat_container.content)
+
+    def show_pending(message: Message):
+        # Shown straight away, dimmed, until the stored message comes back
+        # as a message_added event and replaces it.
+        if message.room == session.room and not has_newer:
+            chat_container.content.controls.append(render_message(message, pending=True))
+            scheduler.schedule(chat_container.content)
+
+    def toggle_reaction(message: Message, emoji: str):
+        page.run_task(run_blocking, session.react, message, emoji)
+
+    @metrics.timed("ui_delete_room")
+    async def delete_room(room):
+        was_open = session.room == room
+        if await run_blocking(session.delete_room, room):
+            if was_open:
                 page.session.remove("room")
                 room_title.value = "No room selected"
                 chat_container.content.controls.clear()
-            update_room_list()
             page.update()
 
-    def join_chat_click(e):
-        nonlocal current_room, user_name
+    @metrics.timed("ui_join")
+    async def join_chat_click(e):
         if not join_user_name.value:
             join_user_name.error_text = "Name cannot be blank!"
             join_user_name.update()
         else:
-            user_name = join_user_name.value
-            page.session.set("user_name", user_name)
+            session.user_name = join_user_name.value
+            page.session.set("user_name", session.user_name)
 
-            if not rooms:
+            room_names = store.room_names()
+            if not room_names:
                 if not room_name.value:
                     room_name.error_text = "Room cannot be blank!"
                     room_name.update()
                     return
-                current_room = room_name.value
-                page.session.set("room", current_room)
-                rooms[current_room] = []
-                save_rooms(rooms)
+                await run_blocking(session.join, room_name.value, created=True)
             else:
-                current_room = list(rooms.keys())[0]
-                page.session.set("room", current_room)
+                await run_blocking(session.join, room_names[0])
+            page.session.set("room", session.room)
 
-            room_title.value = f"Room: {current_room}"
+            room_title.value = f"Room: {session.room}"
             room_title.update()
-            welcome_dlg.open = False
-            new_message.prefix = ft.Text(f"{user_name}: ")
-            page.pubsub.send_all(Message(user_name, f"{user_name} has joined the room {current_room}.", "login_message", current_room))
-            chat_container.content = ft.ListView(expand=True, spacing=10, auto_scroll=True)
-            update_room_list()
+            welcome_dlg.get().open = False
+            new_message.prefix = ft.Text(f"{session.user_name}: ")
+            chat_container.content = new_history_view()
+            await update_room_list()
             page.update()
 
-    def create_room_click(e):
-        nonlocal current_room, user_name
+    @metrics.timed("ui_create_room")
+    async def create_room_click(e):
         if not create_room_user_name.value:
             create_room_user_name.error_text = "Name cannot be blank!"
             create_room_user_name.update()
@@ -136,30 +318,27 @@ def main(page: ft.Page):
             create_room_name.error_text = "Room name cannot be blank!"
             create_room_name.update()
         else:
-            user_name = create_room_user_name.value
-            page.session.set("user_name", user_name)
+            session.user_name = create_room_user_name.value
+            page.session.set("user_name", session.user_name)
 
-            current_room = create_room_name.value
-            page.session.set("room", current_room)
-            rooms[current_room] = []
-            save_rooms(rooms)
+            await run_blocking(session.join, create_room_name.value, created=True)
+            page.session.set("room", session.room)
 
-            room_title.value = f"Room: {current_room}"
+            room_title.value = f"Room: {session.room}"
             room_title.update()
-            create_room_dlg.open = False
-            new_message.prefix = ft.Text(f"{user_name}: ")
-            page.pubsub.send_all(Message(user_name, f"{user_name} has created and joined the room {current_room}.", "login_message", current_room))
-            chat_container.content = ft.ListView(expand=True, spacing=10, auto_scroll=True)
-            update_room_list()
+            create_room_dlg.get().open = False
+            new_message.prefix = ft.Text(f"{session.user_name}: ")
+            chat_container.content = new_history_view()
+            await update_room_list()
             page.update()
 
     def close_create_room_dlg():
-        create_room_dlg.open = False
+        create_room_dlg.get().open = False
         page.update()
 
     create_room_user_name = ft.TextField(label="Enter your name", autofocus=True)
     create_room_name = ft.TextField(label="Enter new room name")
-    create_room_dlg = ft.AlertDialog(
+    create_room_dlg = LazyOverlay(page, lambda: ft.AlertDialog(
         open=False,
         modal=True,
         title=ft.Text("Create New Room"),
@@ -175,51 +354,41 @@ def main(page: ft.Page):
         ],
         actions_alignment=ft.MainAxisAlignment.END,
         on_dismiss=lambda e: close_create_room_dlg(),
-    )
+    ))
 
     def create_new_room(e): 
-        create_room_dlg.open = True
-        if create_room_dlg not in page.overlay:
-            page.overlay.append(create_room_dlg)
+        create_room_dlg.get().open = True
         page.update()
 
-    def send_message_click(e):
-        if new_message.value and current_room:
-            message = Message(
-                user_name,
-                new_message.value,
-                message_type="chat_message",
-                room=current_room,
-            )
-            page.pubsub.send_all(message)
-            
-            rooms[current_room].append(message.__dict__)
-            save_rooms(rooms)
-            
+    @metrics.timed("ui_send_message")
+    async def send_message_click(e):
+        if new_message.value and session.room:
+            message = session.new_message(new_message.value)
             new_message.value = ""
             new_message.focus()
+            show_pending(message)
             page.update()
-
-    def on_file_pick(e: ft.FilePickerResultEvent):
-        if e.files and current_room:
+            
+            try:
+                await run_blocking(session.send, message)
+            except RateLimited as err:
+                drop_pending(message)
+                show_notice(str(err))
+
+    @metrics.timed("ui_file_pick")
+    async def on_file_pick(e: ft.FilePickerResultEvent):
+        if e.files and session.room:
             for file in e.files:
-                with open(file.path, "rb") as f:
-                    file_data = base64.b64encode(f.read()).decode("utf-8")
-                message = Message(
-                    user_name,
-                    "",
-                    message_type="chat_message",
-                    room=current_room,
-                    file_data=file_data,
-                    file_name=file.name,
-                )
-                page.pubsub.send_all(message)
-                rooms[current_room].append(message.__dict__)
-                save_rooms(rooms)
-            page.update()
+                message = session.new_message(f"Sending {file.name}...")
+                show_pending(message)
+                try:
+                    await run_blocking(session.attach, message, file.path, file.name)
+                except RateLimited as err:
+                    drop_pending(message)
+                    show_notice(str(err))
+                    break
 
-    file_picker = ft.FilePicker(on_result=on_file_pick)
-    page.overlay.append(file_picker)
+    file_picker = LazyOverlay(page, lambda: ft.FilePicker(on_result=on_file_pick))
 
     def edit_message(message: Message):
         def on_edit(e):
@@ -232,7 +401,7 @@ def main(page: ft.Page):
                 actions=[
                     ft.ElevatedButton(
                         text="Save",
-                        on_click=lambda e: save_edit(message, new_text.value),
+                        on_click=lambda e: page.run_task(save_edit, message, new_text.value),
                     ),
                     ft.ElevatedButton(
                         text="Cancel",
@@ -243,19 +412,9 @@ def main(page: ft.Page):
             page.overlay.append(edit_dlg)
             page.update()
     
-        def save_edit(message: Message, new_text: str):
-            for idx, msg in enumerate(rooms[message.room]):
-                if isinstance(msg, dict) and msg.get("text") == message.text and msg.get("user_name") == message.user_name:
-                    msg["text"] = new_text
-                    break
-                elif isinstance(msg, Message) and msg.text == message.text and msg.user_name == message.user_name:
-                    msg.text = new_text
-                    rooms[message.room][idx] = msg.__dict__
-                    break
-                
-            save_rooms(rooms)
+        async def save_edit(message: Message, new_text: str):
+            await run_blocking(session.edit, message, new_text)
             close_edit_dlg()
-            select_room(message.room)
     
         def close_edit_dlg():
             page.overlay.pop()
@@ -264,95 +423,111 @@ def main(page: ft.Page):
         on_edit(None)
 
     def delete_message(message: Message):
-        def on_delete(e):
-            rooms[message.room] = [msg for idx, msg in enumerate(rooms[message.room]) if idx != message_index(message)]
-            save_rooms(rooms)
-            select_room(message.room)
-
-        def message_index(message: Message):
-            for idx, msg in enumerate(rooms[message.room]):
-                if isinstance(msg, dict) and msg.get("text") == message.text and msg.get("user_name") == message.user_name:
-                    return idx
-                elif isinstance(msg, Message) and msg.text == message.text and msg.user_name == message.user_name:
-                    return idx
-            return -1
-
-        on_delete(None)
-
-    def on_message(message: Message):
-        if message.room in rooms:
-            if message.message_type == "chat_message":
-                m = ChatMessage(
-                    message, 
-                    on_edit=edit_message, 
-                    on_delete=delete_message,
-                    on_reaction=update_reactions,
-                    current_user=user_name,
-                    highlight=False
-                )
-            elif message.message_type == "login_message":
-                m = ft.Text(message.text, italic=True, color=ft.Colors.GREY_500, size=12)
-            chat_container.content.controls.append(m)
-            page.update()
+        page.run_task(run_blocking, session.delete, message)
 
-    page.pubsub.subscribe(on_message)
+    message_actions = LazyOverlay(page, lambda: MessageActions(edit_message, delete_message, toggle_reaction))
+    image_viewer = LazyOverlay(page, ImageViewer)
 
-    
-    search_query = ft.TextField(label="Search for...", autofocus=True)
-    search_active = False
+    @metrics.timed("ui_on_event")
+    def on_event(event: events.Event):
+        nonlocal has_older
+        if event.kind == events.ROOM_UPDATED:
+            page.run_task(place_room, session.directory_entry(event))
+            return
+        if event.kind == events.ROOM_DELETED:
+            page.run_task(remove_room, event.room)
+            return
+        if event.room != session.room:
+            return
+        if event.kind == events.MESSAGE_ADDED:
+            # While scrolled back in history the newest page is not rendered;
+            # the message is picked up by load_newer when the user gets there.
+            if has_newer:
+                return
+            controls = chat_container.content.controls
+            pending = rendered.get(event.message_id)
+            control = render_message(event.fields["message"].copy())
+            if pending is not None and pending in controls:
+                controls[controls.index(pending)] = control
+            else:
+                controls.append(control)
+            if len(controls) > MAX_RENDERED:
+                drop_controls(0, len(controls) - MAX_RENDERED)
+                has_older = True
+            scheduler.schedule(chat_container.content)
+            return
+        control = rendered.get(event.message_id)
+        if control is None:
+            return
+        if event.kind == events.MESSAGE_EDITED:
+            scheduler.schedule(control.set_text(event.fields["text"]))
+        elif event.kind == events.REACTION_TOGGLED:
+            changed = control.apply_reaction(event.fields["emoji"], event.fields["user_name"], event.fields["added"])
+            if changed is not None:
+                scheduler.schedule(changed)
+        elif event.kind == events.MESSAGE_DELETED:
+            del rendered[event.message_id]
+            chat_container.content.controls.remove(control)
+            scheduler.schedule(chat_container.content)
+
+    # Searches as the user types: narrowing a query is answered from the
+    # cached result of the shorter one.
+    search_query = ft.TextField(
+        label="Search for...",
+        hint_text="from:name room:name has:file",
+        autofocus=True,
+        on_change=lambda e: page.run_task(perform_search, e),
+        on_submit=lambda e: page.run_task(perform_search, e),
+    )
+    search_all_rooms = ft.Checkbox(label="Search all rooms")
+    search_archive = ft.Checkbox(label="Include archive")
+    search_results = ft.ListView(height=300, spacing=2)
 
     def open_search(e):
-        search_dialog.open = True
+        search_dialog.get().open = True
         page.update()
 
-    def perform_search(e):
-        nonlocal search_active
-        query = search_query.value.strip().lower()
-        
-        if not query or not current_room:
+    @metrics.timed("ui_perform_search")
+    async def perform_search(e):
+        query = search_query.value.strip()
+        if not query:
             return
 
-        search_active = True
-        chat_container.content.controls.clear()
-        
-        for message_data in rooms[current_room]:
-            message = Message(**message_data)
-            matches = query in message.text.lower() or query in message.user_name.lower()
-            
-            if message.message_type == "chat_message":
-                m = ChatMessage(
-                    message, 
-                    on_edit=edit_message, 
-                    on_delete=delete_message,
-                    on_reaction=update_reactions,
-                    current_user=user_name,
-                    highlight=matches
-                )
-            elif message.message_type == "login_message":
-                m = ft.Text(message.text, italic=True, color=ft.Colors.GREY_500, size=12)
-            
-            chat_container.content.controls.append(m)
-        
-        search_dialog.open = False
-        page.update()
+        hits = await run_blocking(
+            session.search, query, all_rooms=search_all_rooms.value, include_archive=search_archive.value
+        )
+        if query != search_query.value.strip():
+            return  # typed over while this ran
+        search_results.controls = [
+            search_result(hit, lambda message: page.run_task(jump_to, message.room, message.id)) for hit in hits
+        ] or [ft.Text("No messages found.", italic=True)]
+        scheduler.schedule(search_results)
+
+    async def jump_to(room, message_id):
+        search_dialog.get().open = False
+        await select_room(room, around=message_id)
+        # scroll_to needs the target control on the client already.
+        scheduler.flush()
+        chat_container.content.scroll_to(key=message_id, duration=300)
 
     def clear_search(e):
-        nonlocal search_active
-        search_active = False
         search_query.value = ""
-        select_room(current_room)
-        page.update()
+        search_results.controls.clear()
+        search_dialog.get().update()
 
     def close_dialog(e):
-        search_dialog.open = False
+        search_dialog.get().open = False
         page.update()
 
-    search_dialog = ft.AlertDialog(
+    search_dialog = LazyOverlay(page, lambda: ft.AlertDialog(
         modal=True,
         title=ft.Text("Search Messages"),
         content=ft.Column(
             [
                 search_query,
+                search_all_rooms,
+                search_archive,
+                search_results,
             ],
             width=400,
         ),
@@ -361,30 +536,27 @@ def main(page: ft.Page):
             ft.TextButton("Clear", on_click=clear_search),
             ft.TextButton("Close", on_click=close_dialog),
         ],
-    )
-    page.overlay.append(search_dialog)
+    ))
 
+    has_rooms = bool(directory)
     join_user_name = ft.TextField(label="Enter your name", autofocus=True)
-    room_name = ft.TextField(label="Enter room name", visible=not rooms)
-    welcome_dlg = ft.AlertDialog(
-        open=not user_name,
+    room_name = ft.TextField(label="Enter room name", visible=not has_rooms)
+    welcome_dlg = LazyOverlay(page, lambda: ft.AlertDialog(
+        open=True,
         modal=True,
         title=ft.Text("Welcome!"),
         content=ft.Column(
-            [join_user_name, room_name] if not rooms else [join_user_name],
+            [join_user_name, room_name] if not has_rooms else [join_user_name],
             width=300,
-            height=120 if not rooms else 80,
+            height=120 if not has_rooms else 80,
             tight=True,
         ),
         actions=[ft.ElevatedButton(text="Join Room", on_click=join_chat_click)],
         actions_alignment=ft.MainAxisAlignment.END,
-    )
-
-    if not user_name:
-        page.overlay.append(welcome_dlg)
+    ))
 
     chat_container = ft.Container(
-        content=ft.ListView(expand=True, spacing=10, auto_scroll=True),
+        content=new_history_view(),
         border=ft.border.all(1, ft.Colors.OUTLINE),
         border_radius=5,
         padding=10,
@@ -422,7 +594,6 @@ def main(page: ft.Page):
                         room_list,
                     ],
                     width=220,
-                    scroll=ft.ScrollMode.AUTO,
                     alignment=ft.MainAxisAlignment.START,
                 ),
                 ft.Column(
@@ -433,7 +604,7 @@ def main(page: ft.Page):
                             [
                                 new_message,
                                 ft.IconButton(icon=ft.Icons.SEND_ROUNDED, tooltip="Send message", on_click=send_message_click),
-                                ft.IconButton(icon=ft.icons.ATTACH_FILE, tooltip="Send file", on_click=lambda e: file_picker.pick_files(allow_multiple=True)),
+                                ft.IconButton(icon=ft.icons.ATTACH_FILE, tooltip="Send file", on_click=lambda e: file_picker.get().pick_files(allow_multiple=True)),
                             ],
                             alignment=ft.MainAxisAlignment.END,
                         ),
@@ -445,6 +616,11 @@ def main(page: ft.Page):
         )
     )
 
-    update_room_list()
+    await update_room_list(directory)
+    if not session.user_name:
+        welcome_dlg.get()
+    scheduler.flush()
+    timer.mark("render")
+    timer.done()
 
-ft.app(target=main)
\ No newline at end of file
+ft.app(target=main, assets_dir="assets")
\ No newline at end of file
@@ -0,0 +1,107 @@
+import threading
+from typing import Dict, Iterable
+
+from ids import new_message_id
+
+# Every user name is stored once and referred to by a small integer, so a
+# room's reactions hold ints instead of repeated name strings.
+_user_names = []
+_user_ids = {}
+_intern_lock = threading.Lock()
+
+
+def user_id(name: str) -> int:
+    uid = _user_ids.get(name)
+    if uid is None:
+        with _intern_lock:
+            uid = _user_ids.get(name)
+            if uid is None:
+                uid = _user_ids[name] = len(_user_names)
+                _user_names.append(name)
+    return uid
+
+
+def user_name(uid: int) -> str:
+    return _user_names[uid]
+
+
+class Message:
+    __slots__ = ("id", "room", "user_id", "text", "message_type", "file_data", "file_name", "attachment", "reactions")
+
+    def __init__(self, user_name: str, text: str, message_type: str, room: str,
+                 file_data=None, file_name=None, reactions: Dict[str, Iterable[str]] = None, attachment=None,
+                 id: str = None):
+        self.user_id = user_id(user_name)
+        self.text = text
+        self.message_type = message_type
+        self.room = room
+        self.file_data = file_data
+        self.file_name = file_name
+        # emoji -> set of user ids; len() of the set is the count shown.
+        self.reactions = {emoji: {user_id(name) for name in users} for emoji, users in (reactions or {}).items() if users}
+        self.attachment = attachment
+        self.id = id or new_message_id()
+
+    @property
+    def user_name(self):
+        return _user_names[self.user_id]
+
+    def reaction_count(self, emoji: str) -> int:
+        return len(self.reactions.get(emoji, ()))
+
+    def has_reacted(self, emoji: str, user_name: str) -> bool:
+        return user_id(user_name) in self.reactions.get(emoji, ())
+
+    def add_reaction(self, emoji: str, user_name: str):
+        self.reactions.setdefault(emoji, set()).add(user_id(user_name))
+
+    def remove_reaction(self, emoji: str, user_name: str):
+        users = self.reactions.get(emoji)
+        if users is not None:
+            users.discard(user_id(user_name))
+            if not users:
+                del self.reactions[emoji]
+
+    def toggle_reaction(self, emoji: str, user_name: str) -> bool:
+        added = not self.has_reacted(emoji, user_name)
+        if added:
+            self.add_reaction(emoji, user_name)
+        else:
+            self.remove_reaction(emoji, user_name)
+        return added
+
+    def copy(self):
+        clone = Message.__new__(Message)
+        for slot in Message.__slots__:
+            setattr(clone, slot, getattr(self, slot))
+        clone.reactions = {emoji: set(users) for emoji, users in self.reactions.items()}
+        return clone
+
+    # The on-disk and wire format is a plain dict with user names spelled
+    # out; these two are the only places that convert.
+    def to_dict(self):
+        return {
+            "user_name": self.user_name,
+            "text": self.text,
+            "message_type": self.message_type,
+            "room": self.room,
+            "file_data": self.file_data,
+            "file_name": self.file_name,
+            "reactions": {emoji: [_user_names[uid] for uid in users] for emoji, users in self.reactions.items()},
+            "attachment": self.attachment,
+            "id": self.id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data.get("user_name"),
+            data.get("text"),
+            data.get("message_type", "chat_message"),
+            data.get("room"),
+            file_data=data.get("file_data"),
+            file_name=data.get("file_name"),
+            reactions=data.get("reactions"),
+            attachment=data.get("attachment"),
+            id=data.get("id"),
+        )
@@ -0,0 +1,179 @@
+import atexit
+import collections
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+# Off unless CHAT_METRICS=1. When off, span() hands back a shared no-op and
+# count() returns on its first line, so instrumented code pays one global
+# lookup per call.
+ENABLED = os.environ.get("CHAT_METRICS") == "1"
+EXPORT_FILE = os.environ.get("CHAT_METRICS_FILE")
+EXPORT_INTERVAL = 15.0
+SLOW_DEFAULT = float(os.environ.get("CHAT_SLOW_MS", "100")) / 1000
+# Per-span overrides of SLOW_DEFAULT, in seconds.
+SLOW_THRESHOLDS = {
+    "ui_page_update": 0.05,
+    "ui_build_controls": 0.01,
+    "storage_flush": 0.25,
+    "startup_import": 1.0,
+    "startup_session": 1.0,
+}
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SLOW_LOG_SIZE = 100
+
+logger = logging.getLogger("chat.metrics")
+
+_lock = threading.Lock()
+_counters = collections.Counter()
+_spans = {}  # name -> [count, total, max, bucket counts]
+_slow = collections.deque(maxlen=SLOW_LOG_SIZE)
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] += value
+
+
+def record(name, seconds):
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            stats = _spans[name] = [0, 0.0, 0.0, [0] * len(BUCKETS)]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stats[3][index] += 1
+                break
+        if seconds > SLOW_THRESHOLDS.get(name, SLOW_DEFAULT):
+            _slow.append({"span": name, "ms": seconds * 1000, "at": time.time()})
+        else:
+            return
+    logger.warning("slow %s: %.1f ms", name, seconds * 1000)
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    return _Span(name) if ENABLED else _NULL_SPAN
+
+
+def timed(name):
+    # Decorator form of span() for plain and async functions.
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                if not ENABLED:
+                    return await fn(*args, **kwargs)
+                with _Span(name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not ENABLED:
+                    return fn(*args, **kwargs)
+                with _Span(name):
+                    return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def snapshot():
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "spans": {
+                name: {
+                    "count": stats[0],
+                    "total_s": stats[1],
+                    "max_s": stats[2],
+                    "buckets": dict(zip(BUCKETS, stats[3])),
+                }
+                for name, stats in _spans.items()
+            },
+            "slow": list(_slow),
+        }
+
+
+def prometheus_text():
+    data = snapshot()
+    lines = []
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"# TYPE chat_{name}_total counter")
+        lines.append(f"chat_{name}_total {value}")
+    if data["spans"]:
+        lines.append("# TYPE chat_span_seconds histogram")
+    for name, stats in sorted(data["spans"].items()):
+        cumulative = 0
+        for bound, hits in stats["buckets"].items():
+            cumulative += hits
+            lines.append(f'chat_span_seconds_bucket{{span="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'chat_span_seconds_bucket{{span="{name}",le="+Inf"}} {stats["count"]}')
+        lines.append(f'chat_span_seconds_sum{{span="{name}"}} {stats["total_s"]}')
+        lines.append(f'chat_span_seconds_count{{span="{name}"}} {stats["count"]}')
+    if data["spans"]:
+        lines.append("# TYPE chat_span_max_seconds gauge")
+    for name, stats in sorted(data["spans"].items()):
+        lines.append(f'chat_span_max_seconds{{span="{name}"}} {stats["max_s"]}')
+    return "\n".join(lines) + "\n"
+
+
+def export(path):
+    # Prometheus text for a .prom file (node_exporter's textfile collector
+    # picks these up), a JSON snapshot for anything else.
+    if path.endswith(".prom"):
+        data = prometheus_text()
+    else:
+        data = json.dumps(snapshot(), indent=2)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as file:
+        file.write(data)
+    os.replace(tmp, path)
+
+
+def _export_loop(path):
+    while True:
+        time.sleep(EXPORT_INTERVAL)
+        export(path)
+
+
+if ENABLED and EXPORT_FILE:
+    threading.Thread(target=_export_loop, args=(EXPORT_FILE,), daemon=True, name="metrics-export").start()
+    atexit.register(export, EXPORT_FILE)
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import metrics
+
+FRAME_INTERVAL = 0.05
+MAX_LATENCY = 0.25
+
+
+class UpdateScheduler:
+    # Coalesces UI updates for one session: every schedule() call pushes the
+    # flush back by `interval`, but never past `max_latency` after the first
+    # pending request, so a burst of events costs a handful of update() calls.
+    def __init__(self, page, interval=FRAME_INTERVAL, max_latency=MAX_LATENCY):
+        self.page = page
+        self.interval = interval
+        self.max_latency = max_latency
+        self.ready = threading.Condition()
+        self.controls = {}
+        self.whole_page = False
+        self.due = None
+        self.deadline = None
+        self.closed = False
+        threading.Thread(target=self.run, daemon=True, name="ui-scheduler").start()
+
+    def schedule(self, *controls):
+        with self.ready:
+            if controls:
+                for control in controls:
+                    self.controls[id(control)] = control
+            else:
+                self.whole_page = True
+            now = time.monotonic()
+            if self.deadline is None:
+                self.deadline = now + self.max_latency
+            self.due = min(now + self.interval, self.deadline)
+            self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while self.due is None and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                while self.due is not None and self.due > time.monotonic():
+                    self.ready.wait(self.due - time.monotonic())
+            self.flush()
+
+    def flush(self):
+        with self.ready:
+            controls = list(self.controls.values())
+            whole_page = self.whole_page
+            self.controls.clear()
+            self.whole_page = False
+            self.due = self.deadline = None
+        if not (whole_page or controls):
+            return
+        metrics.count("page_updates")
+        with metrics.span("ui_page_update"):
+            if whole_page:
+                self.page.update()
+            else:
+                self.page.update(*controls)
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
@@ -0,0 +1,295 @@
+import bisect
+import collections
+import math
+import re
+import threading
+import time
+import unicodedata
+import weakref
+
+import metrics
+from ids import message_time
+
+TOKEN_RE = re.compile(r"\w+")
+FILTER_RE = re.compile(r"(from|room|has):(\S+)")
+CACHE_SIZE = 128
+# Hits fetched from the store per query before ranking; a result with fewer
+# than this is complete, so refining it never needs the store again.
+CANDIDATES = 500
+RECENCY_HALF_LIFE = 7 * 86400
+RECENCY_WEIGHT = 1.0
+SNIPPET_CHARS = 120
+
+
+def fold(text):
+    if not text or text.isascii():
+        return (text or "").lower()
+    text = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(fold(text))
+
+
+class SearchIndex:
+    def __init__(self):
+        self.postings = {}  # term -> {room: {message ids}}
+        self.vocabulary = []  # sorted terms, for prefix lookups
+        self.documents = {}  # room -> {message id: terms}
+
+    def add(self, room, message_id, text, user_name):
+        self.remove(room, message_id)
+        terms = set(tokenize(text)) | set(tokenize(user_name))
+        self.documents.setdefault(room, {})[message_id] = terms
+        for term in terms:
+            rooms = self.postings.get(term)
+            if rooms is None:
+                rooms = self.postings[term] = {}
+                bisect.insort(self.vocabulary, term)
+            rooms.setdefault(room, set()).add(message_id)
+
+    def remove(self, room, message_id):
+        terms = self.documents.get(room, {}).pop(message_id, ())
+        for term in terms:
+            self._unpost(term, room, message_id)
+
+    def remove_room(self, room):
+        for message_id, terms in self.documents.pop(room, {}).items():
+            for term in terms:
+                self._unpost(term, room, message_id)
+
+    def _unpost(self, term, room, message_id):
+        rooms = self.postings[term]
+        ids = rooms[room]
+        ids.discard(message_id)
+        if not ids:
+            del rooms[room]
+        if not rooms:
+            del self.postings[term]
+            del self.vocabulary[bisect.bisect_left(self.vocabulary, term)]
+
+    def _matches(self, token, room, prefix):
+        if not prefix:
+            terms = [token] if token in self.postings else []
+        else:
+            start = bisect.bisect_left(self.vocabulary, token)
+            end = bisect.bisect_left(self.vocabulary, token + "\uffff", start)
+            terms = self.vocabulary[start:end]
+        found = {}
+        for term in terms:
+            for term_room, ids in self.postings[term].items():
+                if room is None or term_room == room:
+                    found.setdefault(term_room, set()).update(ids)
+        return found
+
+    def search(self, query, room=None, prefix=True):
+        # Every query token must match (as a term prefix by default); returns
+        # (room, message id) pairs.
+        result = None
+        for token in tokenize(query):
+            found = self._matches(token, room, prefix)
+            if result is None:
+                result = found
+            else:
+                result = {r: ids & found[r] for r, ids in result.items() if r in found}
+        return [(r, message_id) for r, ids in (result or {}).items() for message_id in ids]
+
+
+def matches(tokens, message):
+    # Same rule as SearchIndex: every token is a prefix of some term.
+    if message.message_type != "chat_message":
+        return False
+    terms = set(tokenize(message.text)) | set(tokenize(message.user_name))
+    return all(any(term.startswith(token) for term in terms) for token in tokens)
+
+
+def display_text(message):
+    return message.text or (message.attachment or {}).get("name") or message.file_name or ""
+
+
+class Query:
+    # Free text plus filters: from:user, room:name, has:file, has:image.
+    def __init__(self, text):
+        self.filters = {}
+        words = []
+        for word in text.split():
+            match = FILTER_RE.fullmatch(word)
+            if match:
+                self.filters[match.group(1)] = match.group(2)
+            else:
+                words.append(word)
+        self.text = " ".join(words)
+        self.tokens = tokenize(self.text)
+
+    def accepts(self, message, terms=True):
+        # terms=False when the store has already matched the text.
+        if terms and not matches(self.tokens, message):
+            return False
+        if message.message_type != "chat_message":
+            return False
+        user = self.filters.get("from")
+        if user is not None and fold(message.user_name) != fold(user):
+            return False
+        kind = self.filters.get("has")
+        if kind == "file" and not (message.attachment or message.file_data):
+            return False
+        if kind == "image" and not (message.attachment and message.attachment["mime"].startswith("image/")):
+            return False
+        return True
+
+    def refines(self, other):
+        # Whether every message matching self also matches other, so other's
+        # complete result can be filtered instead of searching again.
+        if any(self.filters.get(name) != value for name, value in other.filters.items()):
+            return False
+        return all(any(token.startswith(old) for token in self.tokens) for old in other.tokens)
+
+
+class SearchHit:
+    __slots__ = ("message", "score", "snippet")
+
+    def __init__(self, message, score):
+        self.message = message
+        self.score = score
+        self.snippet = None
+
+
+def score(tokens, message, now):
+    # Term frequency of the query in the message, plus a recency bonus that
+    # halves every RECENCY_HALF_LIFE seconds.
+    terms = tokenize(display_text(message))
+    frequency = sum(1 for term in terms for token in tokens if term.startswith(token))
+    age = max(now - message_time(message.id), 0)
+    return math.log1p(frequency) + RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE)
+
+
+def snippet(text, tokens, width=SNIPPET_CHARS):
+    # The part of text around the first match as (segment, highlighted)
+    # pairs, cut to about `width` characters.
+    spans = [
+        (match.start(), match.end())
+        for match in TOKEN_RE.finditer(text)
+        if any(fold(match.group()).startswith(token) for token in tokens)
+    ]
+    start = 0
+    if len(text) > width and spans:
+        start = max(0, spans[0][0] - width // 3)
+        start = text.rfind(" ", 0, start) + 1 if start else 0
+    end = min(len(text), start + width)
+    segments = [("…", False)] if start else []
+    position = start
+    for span_start, span_end in spans:
+        if span_start < start or span_end > end:
+            continue
+        segments.append((text[position:span_start], False))
+        segments.append((text[span_start:span_end], True))
+        position = span_end
+    segments.append((text[position:end], False))
+    if end < len(text):
+        segments.append(("…", False))
+    return [segment for segment in segments if segment[0]]
+
+
+class CachedResult:
+    __slots__ = ("query", "versions", "candidates", "hits", "complete")
+
+    def __init__(self, query, versions, candidates, hits, complete):
+        self.query = query
+        self.versions = versions
+        self.candidates = candidates
+        self.hits = hits
+        self.complete = complete
+
+
+class SearchService:
+    # Ranked search over a store with an LRU of recent results. An entry is
+    # valid while the version counters of the rooms it covers are unchanged;
+    # a query that narrows a cached complete one is answered by filtering it.
+    def __init__(self, store, size=CACHE_SIZE):
+        self.store = store
+        self.size = size
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+
+    def search(self, text, room=None, limit=None, include_archive=False):
+        query = Query(text)
+        room = query.filters.get("room", room)
+        if not query.tokens and not query.filters:
+            return []
+        versions = self.store.room_versions()
+        if room is not None:
+            versions = {room: versions.get(room)}
+        key = (tuple(sorted(query.tokens)), tuple(sorted(query.filters.items())), room, include_archive)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry.versions == versions:
+                self.cache.move_to_end(key)
+                metrics.count("search_cache_hits")
+                return self._finish(entry, limit)
+            base = next(
+                (
+                    cached for cached_key, cached in reversed(self.cache.items())
+                    if cached_key[2:] == key[2:] and cached.complete and cached.versions == versions
+                    and query.refines(cached.query)
+                ),
+                None,
+            )
+        metrics.count("search_cache_misses")
+        if base is not None:
+            candidates = [message for message in base.candidates if query.accepts(message)]
+            complete = True
+        else:
+            candidates, complete = self._fetch(query, room, include_archive)
+        now = time.time()
+        hits = [SearchHit(message, score(query.tokens, message, now)) for message in candidates]
+        hits.sort(key=lambda hit: (hit.score, hit.message.id), reverse=True)
+        entry = CachedResult(query, versions, candidates, hits, complete)
+        with self.lock:
+            self.cache[key] = entry
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+        return self._finish(entry, limit)
+
+    def _fetch(self, query, room, include_archive):
+        with metrics.span("search_fetch"):
+            # from: alone still narrows the store search, since user names
+            # are indexed alongside the text.
+            text = query.text or query.filters.get("from")
+            if text:
+                found = self.store.search(text, room=room, limit=CANDIDATES, include_archive=include_archive)
+                complete = len(found) < CANDIDATES
+            else:
+                found = self._scan(room, include_archive)
+                complete = True
+            return [message for message in found if query.accepts(message, terms=not text)], complete
+
+    def _scan(self, room, include_archive):
+        # Filter-only queries such as has:file have no terms to look up.
+        found = []
+        for name in [room] if room is not None else self.store.room_names():
+            found.extend(message for _, message in self.store.messages(name))
+            if include_archive:
+                found.extend(self.store.archive.iter_messages(name))
+        return found
+
+    def _finish(self, entry, limit):
+        hits = entry.hits[:limit]
+        for hit in hits:
+            if hit.snippet is None:
+                hit.snippet = snippet(display_text(hit.message), entry.query.tokens)
+        return hits
+
+
+_services = weakref.WeakKeyDictionary()
+_services_lock = threading.Lock()
+
+
+def search_service(store):
+    # One service, and so one cache, per store.
+    with _services_lock:
+        service = _services.get(store)
+        if service is None:
+            service = _services[store] = SearchService(store)
+        return service
@@ -0,0 +1,464 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import archive
+import metrics
+from ids import message_time, new_message_id
+from message import Message
+from storage import DATA_DIR, PREVIEW_LENGTH, SAVE_FILE, load_manifest, load_segment
+
+DB_FILE = "chat_rooms.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS rooms (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    uid TEXT,
+    room TEXT NOT NULL REFERENCES rooms(name) ON DELETE CASCADE,
+    user_name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    file_data TEXT,
+    file_name TEXT,
+    attachment TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_room_id ON messages(room, id);
+CREATE TABLE IF NOT EXISTS reactions (
+    message_id INTEGER NOT NULL REFERENCES messages(id) ON DELETE CASCADE,
+    emoji TEXT NOT NULL,
+    user_name TEXT NOT NULL,
+    PRIMARY KEY (message_id, emoji, user_name)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, user_name, content='messages', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts(rowid, text, user_name) VALUES (new.id, new.text, new.user_name);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text, user_name)
+    VALUES ('delete', old.id, old.text, old.user_name);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF text, user_name ON messages BEGIN
+    INSERT INTO messages_fts(messages_fts, rowid, text, user_name)
+    VALUES ('delete', old.id, old.text, old.user_name);
+    INSERT INTO messages_fts(rowid, text, user_name) VALUES (new.id, new.text, new.user_name);
+END;
+"""
+
+# Created after the rooms columns it uses exist on databases from before
+# the room directory.
+DIRECTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reads (
+    room TEXT NOT NULL REFERENCES rooms(name) ON DELETE CASCADE,
+    user_name TEXT NOT NULL,
+    last_id INTEGER NOT NULL,
+    PRIMARY KEY (room, user_name)
+);
+CREATE TRIGGER IF NOT EXISTS rooms_message_ai AFTER INSERT ON messages BEGIN
+    UPDATE rooms SET message_count = message_count + 1, last_id = new.id WHERE name = new.room;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_message_ad AFTER DELETE ON messages BEGIN
+    UPDATE rooms SET message_count = message_count - 1,
+        last_id = (SELECT MAX(id) FROM messages WHERE room = old.room)
+    WHERE name = old.room;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_version_au AFTER UPDATE OF text ON messages BEGIN
+    UPDATE rooms SET version = version + 1 WHERE name = new.room;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_version_ai AFTER INSERT ON messages BEGIN
+    UPDATE rooms SET version = version + 1 WHERE name = new.room;
+END;
+CREATE TRIGGER IF NOT EXISTS rooms_version_ad AFTER DELETE ON messages BEGIN
+    UPDATE rooms SET version = version + 1 WHERE name = old.room;
+END;
+"""
+
+# Unread is counted off the (room, id) index, so it costs O(unread).
+DIRECTORY_SELECT = """
+SELECT r.name, r.message_count, r.created, m.uid, m.user_name, m.text, m.attachment, m.file_name,
+    (SELECT COUNT(*) FROM messages u WHERE u.room = r.name AND u.id > COALESCE(rd.last_id, 0))
+FROM rooms r
+LEFT JOIN messages m ON m.id = r.last_id
+LEFT JOIN reads rd ON rd.room = r.name AND rd.user_name = ?
+"""
+
+SUMMARY_SELECT = """
+SELECT r.name, r.message_count, r.created, m.uid, m.user_name, m.text, m.attachment, m.file_name, NULL
+FROM rooms r
+LEFT JOIN messages m ON m.id = r.last_id
+WHERE r.name = ?
+"""
+
+MESSAGE_COLUMNS = ("user_name", "text", "message_type", "room", "file_data", "file_name", "attachment")
+SELECT_COLUMNS = "id, uid, " + ", ".join(MESSAGE_COLUMNS)
+
+
+def _fts_query(query):
+    # Quote every token so user input is never parsed as FTS syntax, and
+    # prefix-match the terms to stay close to the old substring search.
+    terms = ['"' + term.replace('"', '""') + '"*' for term in query.split()]
+    return " ".join(terms)
+
+
+class SqliteBackend:
+    def __init__(self, path=DB_FILE):
+        self.lock = threading.Lock()
+        self.archive = archive.ColdArchive(os.path.join(os.path.dirname(os.path.abspath(path)), "chat_archive"))
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        with self.db:
+            self.db.executescript(SCHEMA)
+            columns = {row[1] for row in self.db.execute("PRAGMA table_info(messages)")}
+            if "attachment" not in columns:
+                self.db.execute("ALTER TABLE messages ADD COLUMN attachment TEXT")
+            if "uid" not in columns:
+                self.db.execute("ALTER TABLE messages ADD COLUMN uid TEXT")
+                rows = self.db.execute("SELECT id FROM messages ORDER BY id").fetchall()
+                self.db.executemany(
+                    "UPDATE messages SET uid = ? WHERE id = ?", [(new_message_id(), row[0]) for row in rows]
+                )
+            self.db.execute("CREATE UNIQUE INDEX IF NOT EXISTS messages_uid ON messages(uid)")
+            room_columns = {row[1] for row in self.db.execute("PRAGMA table_info(rooms)")}
+            if "message_count" not in room_columns:
+                self.db.execute("ALTER TABLE rooms ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0")
+                self.db.execute("ALTER TABLE rooms ADD COLUMN last_id INTEGER")
+                self.db.execute("ALTER TABLE rooms ADD COLUMN created REAL")
+                self.db.execute(
+                    "UPDATE rooms SET message_count = (SELECT COUNT(*) FROM messages WHERE room = rooms.name), "
+                    "last_id = (SELECT MAX(id) FROM messages WHERE room = rooms.name)"
+                )
+            if "version" not in room_columns:
+                self.db.execute("ALTER TABLE rooms ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            self.db.executescript(DIRECTORY_SCHEMA)
+        self.migrate_json()
+
+    def migrate_json(self, path=SAVE_FILE):
+        with self.lock, self.db:
+            # Take the write lock before checking, so that when several
+            # processes start together only the first one migrates.
+            self.db.execute("BEGIN IMMEDIATE")
+            done = self.db.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone()
+            if done or not (os.path.exists(path) or os.path.exists(os.path.join(DATA_DIR, "manifest.json"))):
+                return
+            # load_manifest upgrades a legacy snapshot once; after that the
+            # rooms are copied one segment at a time.
+            meta, pending = load_manifest()
+            for room in meta:
+                self.db.execute("INSERT OR IGNORE INTO rooms(name) VALUES (?)", (room,))
+                for message in load_segment(meta, room, pending.get(room, ())).values():
+                    self._insert_message(room, message)
+            self.db.execute("INSERT INTO meta(key, value) VALUES ('migrated_json', ?)", (path,))
+
+    def _insert_message(self, room, message):
+        cursor = self.db.execute(
+            "INSERT INTO messages(uid, room, user_name, text, message_type, file_data, file_name, attachment) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                message.get("id") or new_message_id(),
+                room,
+                message.get("user_name") or "",
+                message.get("text") or "",
+                message.get("message_type", "chat_message"),
+                message.get("file_data"),
+                message.get("file_name"),
+                json.dumps(message["attachment"]) if message.get("attachment") else None,
+            ),
+        )
+        self._set_reactions(cursor.lastrowid, message.get("reactions") or {})
+
+    def _set_reactions(self, rowid, reactions):
+        self.db.execute("DELETE FROM reactions WHERE message_id = ?", (rowid,))
+        self.db.executemany(
+            "INSERT OR IGNORE INTO reactions(message_id, emoji, user_name) VALUES (?, ?, ?)",
+            [(rowid, emoji, user) for emoji, users in reactions.items() for user in users],
+        )
+
+    def _rowid(self, room, message_id):
+        row = self.db.execute(
+            "SELECT id FROM messages WHERE uid = ? AND room = ?", (message_id, room)
+        ).fetchone()
+        return row[0] if row else None
+
+    def room_names(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT name FROM rooms ORDER BY id")]
+
+    def room_versions(self):
+        # Bumped by triggers on every insert, text edit and delete, in every
+        # process sharing the database; a deleted room drops out.
+        with self.lock:
+            return dict(self.db.execute("SELECT name, version FROM rooms"))
+
+    def _bump(self, room):
+        with self.db:
+            self.db.execute("UPDATE rooms SET version = version + 1 WHERE name = ?", (room,))
+
+    def has_room(self, room):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM rooms WHERE name = ?", (room,)).fetchone() is not None
+
+    def _entry(self, row):
+        name, count, created, uid, user_name, text, attachment, file_name, unread = row
+        preview = None
+        if uid is not None:
+            text = text or (json.loads(attachment)["name"] if attachment else file_name) or ""
+            preview = {"id": uid, "user_name": user_name, "text": text[:PREVIEW_LENGTH]}
+        entry = {
+            "room": name,
+            "count": count,
+            "last_activity": max(created or 0, message_time(uid) if uid else 0),
+            "preview": preview,
+        }
+        if unread is not None:
+            entry["unread"] = unread
+        return entry
+
+    def room_entry(self, room, user_name):
+        with self.lock:
+            row = self.db.execute(DIRECTORY_SELECT + " WHERE r.name = ?", (user_name, room)).fetchone()
+        return self._entry(row) if row else None
+
+    def room_summary(self, room):
+        # A directory entry without the reader-specific unread count.
+        with self.lock:
+            row = self.db.execute(SUMMARY_SELECT, (room,)).fetchone()
+        return self._entry(row) if row else None
+
+    @metrics.timed("storage_directory")
+    def directory(self, user_name):
+        with self.lock:
+            rows = self.db.execute(DIRECTORY_SELECT, (user_name,)).fetchall()
+        entries = [self._entry(row) for row in rows]
+        entries.sort(key=lambda entry: entry["last_activity"], reverse=True)
+        return entries
+
+    def mark_read(self, room, user_name):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO reads(room, user_name, last_id) "
+                "SELECT name, ?, COALESCE(last_id, 0) FROM rooms WHERE name = ?",
+                (user_name, room),
+            )
+
+    def _hydrate(self, rows):
+        reactions = {}
+        for start in range(0, len(rows), 500):
+            rowids = [row[0] for row in rows[start:start + 500]]
+            for rowid, emoji, user in self.db.execute(
+                "SELECT message_id, emoji, user_name FROM reactions "
+                f"WHERE message_id IN ({', '.join('?' * len(rowids))}) ORDER BY rowid",
+                rowids,
+            ):
+                reactions.setdefault(rowid, {}).setdefault(emoji, []).append(user)
+        result = []
+        for row in rows:
+            message = dict(zip(MESSAGE_COLUMNS, row[2:]))
+            if message["attachment"]:
+                message["attachment"] = json.loads(message["attachment"])
+            message["id"] = row[1]
+            message["reactions"] = reactions.get(row[0], {})
+            result.append(Message.from_dict(message))
+        return result
+
+    @metrics.timed("storage_messages")
+    def messages(self, room, before=None, after=None, limit=None):
+        anchor = before if before is not None else after
+        with self.lock:
+            anchored = anchor is not None and self._rowid(room, anchor) is not None
+        if anchor is not None and not anchored:
+            # The anchor is archived (or gone): everything hot is newer.
+            hot = [] if before is not None else self._hot_page(room, None, None, limit, "ASC")
+        else:
+            order = "DESC" if after is None and limit is not None else "ASC"
+            hot = self._hot_page(room, before, after, limit, order)
+        return archive.page(self.archive, room, hot, before, after, limit, anchored)
+
+    def _hot_page(self, room, before, after, limit, order):
+        where = "room = ?"
+        params = [room]
+        if before is not None:
+            where += " AND id < (SELECT id FROM messages WHERE uid = ?)"
+            params.append(before)
+        if after is not None:
+            where += " AND id > (SELECT id FROM messages WHERE uid = ?)"
+            params.append(after)
+        sql = f"SELECT {SELECT_COLUMNS} FROM messages WHERE {where} ORDER BY id {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+            if order == "DESC":
+                rows.reverse()
+            return [(message.id, message) for message in self._hydrate(rows)]
+
+    @metrics.timed("storage_get_message")
+    def get_message(self, room, message_id):
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {SELECT_COLUMNS} FROM messages WHERE uid = ? AND room = ?", (message_id, room)
+            ).fetchall()
+            messages = self._hydrate(rows)
+        return messages[0] if messages else self.archive.get(room, message_id)
+
+    @metrics.timed("storage_search")
+    def search(self, query, room=None, limit=None, include_archive=False):
+        if not query.split():
+            return []
+        found = self._search_hot(query, room, limit)
+        if include_archive:
+            rooms = [room] if room is not None else self.room_names()
+            found += self.archive.search(query, rooms, limit)
+            found.sort(key=lambda message: message.id, reverse=True)
+        return found[:limit]
+
+    def _search_hot(self, query, room, limit):
+        sql = (
+            f"SELECT {', '.join('m.' + c for c in SELECT_COLUMNS.split(', '))} "
+            "FROM messages_fts f JOIN messages m ON m.id = f.rowid "
+            "WHERE messages_fts MATCH ? AND m.message_type = 'chat_message'"
+        )
+        params = [_fts_query(query)]
+        if room is not None:
+            sql += " AND m.room = ?"
+            params.append(room)
+        sql += " ORDER BY m.id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return self._hydrate(self.db.execute(sql, params).fetchall())
+
+    @metrics.timed("storage_create_room")
+    def create_room(self, room):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO rooms(name, created) VALUES (?, ?)", (room, time.time()))
+
+    @metrics.timed("storage_delete_room")
+    def delete_room(self, room):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM messages WHERE room = ?", (room,))
+            self.db.execute("DELETE FROM rooms WHERE name = ?", (room,))
+        self.archive.remove_room(room)
+
+    @metrics.timed("storage_add_message")
+    def add_message(self, room, message):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO rooms(name, created) VALUES (?, ?)", (room, time.time()))
+            self._insert_message(room, message.to_dict())
+
+    @metrics.timed("storage_add_messages")
+    def add_messages(self, room, messages):
+        # One transaction per call; ids that already exist are skipped.
+        added = 0
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO rooms(name, created) VALUES (?, ?)", (room, time.time()))
+            for message in messages:
+                if self.db.execute("SELECT 1 FROM messages WHERE uid = ?", (message.id,)).fetchone() is None:
+                    self._insert_message(room, message.to_dict())
+                    added += 1
+        return added
+
+    def bulk_import(self):
+        # Every add_messages call is already a single transaction.
+        return contextlib.nullcontext()
+
+    def iter_messages(self, room, after=None, batch=500):
+        # Oldest first, archived partitions before the hot rows, which come in
+        # keyset pages by rowid. An `after` that was deleted since starts the
+        # room over; importers skip what they already have.
+        if after is None or self.archive.get(room, after) is not None:
+            for message in self.archive.iter_messages(room):
+                if after is None or message.id > after:
+                    yield message
+            after = None
+        with self.lock:
+            rowid = (self._rowid(room, after) if after is not None else None) or 0
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    f"SELECT {SELECT_COLUMNS} FROM messages WHERE room = ? AND id > ? ORDER BY id LIMIT ?",
+                    (room, rowid, batch),
+                ).fetchall()
+                messages = self._hydrate(rows)
+            yield from messages
+            if len(rows) < batch:
+                return
+            rowid = rows[-1][0]
+
+    @metrics.timed("storage_update_message")
+    def update_message(self, room, message_id, fields):
+        with self.lock, self.db:
+            rowid = self._rowid(room, message_id)
+            if rowid is None:
+                self.archive.update(room, message_id, fields)
+                self._bump(room)
+                return
+            if "reactions" in fields:
+                self._set_reactions(rowid, fields["reactions"])
+            columns = [column for column in ("text", "file_data", "file_name") if column in fields]
+            if columns:
+                self.db.execute(
+                    f"UPDATE messages SET {', '.join(c + ' = ?' for c in columns)} WHERE id = ?",
+                    [fields[c] for c in columns] + [rowid],
+                )
+
+    @metrics.timed("storage_toggle_reaction")
+    def toggle_reaction(self, room, message_id, emoji, user_name):
+        with self.lock, self.db:
+            rowid = self._rowid(room, message_id)
+            if rowid is None:
+                return self.archive.change(room, message_id, lambda archived: archived.toggle_reaction(emoji, user_name))
+            removed = self.db.execute(
+                "DELETE FROM reactions WHERE message_id = ? AND emoji = ? AND user_name = ?",
+                (rowid, emoji, user_name),
+            ).rowcount
+            if removed:
+                return False
+            self.db.execute(
+                "INSERT INTO reactions(message_id, emoji, user_name) VALUES (?, ?, ?)", (rowid, emoji, user_name)
+            )
+            return True
+
+    def flush(self):
+        pass
+
+    @metrics.timed("storage_retention")
+    def enforce_retention(self, days=archive.RETENTION_DAYS):
+        # Archive first, then delete in one transaction; a crash in between
+        # leaves copies in both places, which the next pass merges away.
+        bound = archive.cutoff_id(days)
+        with self.lock:
+            rooms = [row[0] for row in self.db.execute("SELECT DISTINCT room FROM messages WHERE uid < ?", (bound,))]
+        moved = 0
+        for room in rooms:
+            with self.lock:
+                rows = self.db.execute(
+                    f"SELECT {SELECT_COLUMNS} FROM messages WHERE room = ? AND uid < ? ORDER BY id", (room, bound)
+                ).fetchall()
+                self.archive.add(room, self._hydrate(rows))
+                with self.db:
+                    self.db.execute("DELETE FROM messages WHERE room = ? AND uid < ?", (room, bound))
+            moved += len(rows)
+        return moved
+
+    @metrics.timed("storage_delete_message")
+    def delete_message(self, room, message_id):
+        with self.lock, self.db:
+            deleted = self.db.execute("DELETE FROM messages WHERE uid = ? AND room = ?", (message_id, room)).rowcount
+        if not deleted and self.archive.delete(room, message_id):
+            with self.lock:
+                self._bump(room)
@@ -0,0 +1,51 @@
+import logging
+import os
+import time
+
+import metrics
+
+# Imported first by main.py, so this is as close to process start as the
+# app's own code gets; `python -X importtime src/main.py` covers the rest.
+PROCESS_START = time.perf_counter()
+REPORT = os.environ.get("CHAT_STARTUP_REPORT") == "1"
+
+logger = logging.getLogger("chat.startup")
+
+_imports = None
+
+
+def imports_done():
+    global _imports
+    if _imports is None:
+        _imports = time.perf_counter() - PROCESS_START
+        if metrics.ENABLED:
+            metrics.record("startup_import", _imports)
+
+
+class SessionStartup:
+    # Time from a page connecting to its first interactive render, split into
+    # phases. With metrics on, each phase is also recorded as a span, so
+    # they show up in the metrics export alongside the process import time.
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = now - self.last
+        if metrics.ENABLED:
+            metrics.record(f"startup_{phase}", self.phases[phase])
+        self.last = now
+
+    def done(self):
+        total = time.perf_counter() - self.start
+        if metrics.ENABLED:
+            metrics.record("startup_session", total)
+        phases = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in self.phases.items())
+        line = f"session interactive in {total * 1000:.0f} ms ({phases})"
+        if _imports is not None:
+            line += f"; imports took {_imports * 1000:.0f} ms"
+        logger.info(line)
+        if REPORT:
+            print(line, flush=True)
+        return total
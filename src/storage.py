@@ -1,19 +1,869 @@
+import atexit
+import contextlib
+import gzip
+import hashlib
+import itertools
 import json
+import logging
 import os
+import threading
+import time
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+import archive
+import metrics
+from ids import message_time, new_message_id
+from message import Message
+from search import SearchIndex
+
+# Legacy single-file snapshot, migrated into DATA_DIR the first time it is seen.
 SAVE_FILE = "chat_rooms.json"
+DATA_DIR = "chat_data"
+JOURNAL_FILE = "chat_rooms.journal"
+COMPRESS_SEGMENTS = True
+COMPACT_EVERY = 500
+FLUSH_INTERVAL = 0.2
+FLUSH_BATCH = 256
+PREVIEW_LENGTH = 80
+JOURNAL_TAIL_CHUNK = 4096
 
-def load_rooms():
+_lock = threading.RLock()
+_compact_lock = threading.Lock()
+_journal = None
+_seq = 0
+_pending = 0
+_deferred = 0
+_compacting = False
+
+logger = logging.getLogger("chat.storage")
+
+
+def _old_journal():
+    return JOURNAL_FILE + ".old"
+
+
+def _manifest_path():
+    return os.path.join(DATA_DIR, "manifest.json")
+
+
+def _segment_path(file_name):
+    return os.path.join(DATA_DIR, "rooms", file_name)
+
+
+def _segment_file(room):
+    suffix = ".json.gz" if COMPRESS_SEGMENTS else ".json"
+    return hashlib.sha1(room.encode("utf-8")).hexdigest()[:20] + suffix
+
+
+def _atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp, path)
+    metrics.count("bytes_persisted", len(data))
+
+
+def _read_segment(file_name):
+    path = _segment_path(file_name)
+    if not os.path.exists(path):
+        return []
+    opener = gzip.open if file_name.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _write_segment(file_name, messages):
+    data = json.dumps(list(messages)).encode("utf-8")
+    if file_name.endswith(".gz"):
+        data = gzip.compress(data, compresslevel=5)
+    _atomic_write(_segment_path(file_name), data)
+
+
+def _new_meta(room, created=None):
+    return {"file": _segment_file(room), "count": 0, "added": 0, "last_activity": created or time.time(),
+            "preview": None, "reads": {}, "oldest": None}
+
+
+def _preview(msg):
+    text = msg.get("text") or (msg.get("attachment") or {}).get("name") or msg.get("file_name") or ""
+    return {"id": msg["id"], "user_name": msg.get("user_name"), "text": text[:PREVIEW_LENGTH]}
+
+
+def _room_meta(room, messages, previous=None):
+    # Derives count, activity and preview from a room's messages (dicts by
+    # id); the add counter and read markers only live in the metadata, so
+    # they carry over from `previous`.
+    previous = previous or {}
+    last = max((message_time(message_id) for message_id in messages), default=previous.get("last_activity", 0))
+    newest = next(reversed(messages.values()), None)
+    return {
+        "file": _segment_file(room),
+        "count": len(messages),
+        "added": max(previous.get("added", 0), len(messages)),
+        "last_activity": last,
+        "preview": _preview(newest) if newest is not None else None,
+        "reads": previous.get("reads", {}),
+        "oldest": min(messages, default=None),
+    }
+
+
+def _fold_meta(entry, record):
+    # Applies one journal record to a room's metadata without its segment.
+    op = record["op"]
+    if op == "add_message":
+        entry["count"] += 1
+        entry["added"] = entry.get("added", entry["count"] - 1) + 1
+        entry["last_activity"] = max(entry["last_activity"], message_time(record["message"].get("id")))
+        entry["preview"] = _preview(record["message"])
+        message_id = record["message"].get("id")
+        if message_id and (entry.get("oldest") is None or message_id < entry["oldest"]):
+            entry["oldest"] = message_id
+    elif op == "delete_message":
+        entry["count"] = max(entry["count"] - 1, 0)
+        if entry.get("preview") and entry["preview"]["id"] == record.get("id"):
+            # The next newest message is only known from the segment.
+            entry["preview"] = None
+    elif op == "update_message":
+        preview = entry.get("preview")
+        if preview and preview["id"] == record.get("id") and "text" in record["fields"]:
+            preview["text"] = (record["fields"]["text"] or "")[:PREVIEW_LENGTH]
+    elif op == "mark_read":
+        entry.setdefault("reads", {})[record["user_name"]] = record["added"]
+    elif op == "archive_messages":
+        entry["count"] = max(entry["count"] - record["moved"], 0)
+        entry["oldest"] = record["oldest"]
+
+
+def _write_manifest(meta, seq):
+    _atomic_write(_manifest_path(), json.dumps({"format": 3, "seq": seq, "rooms": meta}).encode("utf-8"))
+
+
+def _prepare(msg):
+    # Repairs legacy records in place: list-shaped reactions and missing ids.
+    if isinstance(msg.get("reactions"), list):
+        msg["reactions"] = {}
+    if not msg.get("id"):
+        msg["id"] = new_message_id()
+
+
+def _index_messages(messages):
+    indexed = {}
+    for msg in messages:
+        _prepare(msg)
+        indexed[msg["id"]] = msg
+    return indexed
+
+
+def _list_rooms(rooms):
+    return {room: list(messages.values()) for room, messages in rooms.items()}
+
+
+def _message_id(messages, record):
+    # Journals written before messages had ids address them by position.
+    if "index" in record:
+        return list(messages)[record["index"]]
+    return record["id"]
+
+
+def _apply(rooms, record):
+    # Every id-addressed record is idempotent, so replaying one that is
+    # already reflected in a segment is harmless.
+    op = record["op"]
+    room = record["room"]
+    if op == "create_room":
+        rooms.setdefault(room, {})
+    elif op == "delete_room":
+        rooms.pop(room, None)
+    elif op == "add_message":
+        msg = record["message"]
+        _prepare(msg)
+        rooms.setdefault(room, {})[msg["id"]] = msg
+    elif op == "update_message":
+        rooms[room][_message_id(rooms[room], record)].update(record["fields"])
+    elif op == "delete_message":
+        rooms[room].pop(_message_id(rooms[room], record), None)
+    elif op == "archive_messages":
+        # The messages are already in the cold archive by the time this is
+        # journaled; the segment just drops them.
+        rooms[room] = {message_id: msg for message_id, msg in rooms[room].items() if message_id >= record["before"]}
+    elif op == "set_reaction":
+        msg = rooms[room][_message_id(rooms[room], record)]
+        users = msg.setdefault("reactions", {}).setdefault(record["emoji"], [])
+        if record["added"] and record["user_name"] not in users:
+            users.append(record["user_name"])
+        elif not record["added"] and record["user_name"] in users:
+            users.remove(record["user_name"])
+        if not users:
+            del msg["reactions"][record["emoji"]]
+
+
+def _apply_all(rooms, records):
+    for record in records:
+        try:
+            _apply(rooms, record)
+        except (KeyError, IndexError):
+            pass
+
+
+def _read_journal(path, after):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A torn write from a crash. It can only be the last line:
+                # _open_journal cuts it off before anything is appended.
+                continue
+            if record["seq"] > after:
+                records.append(record)
+    return records
+
+
+def _open_journal():
+    # A crash can leave a final record without its newline. Appending to it
+    # would merge the next record into the same unparsable line, so the file
+    # is first cut back to its last complete line.
+    if os.path.exists(JOURNAL_FILE):
+        with open(JOURNAL_FILE, "rb+") as file:
+            position = file.seek(0, os.SEEK_END)
+            while position > 0:
+                step = min(JOURNAL_TAIL_CHUNK, position)
+                position -= step
+                file.seek(position)
+                end = file.read(step).rfind(b"\n")
+                if end != -1:
+                    file.truncate(position + end + 1)
+                    break
+            else:
+                file.truncate(0)
+    return open(JOURNAL_FILE, "a")
+
+
+def _close_journal():
+    global _journal
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+
+
+def _reset_journal():
+    global _pending
+    _close_journal()
+    for path in (JOURNAL_FILE, _old_journal()):
+        if os.path.exists(path):
+            os.remove(path)
+    _pending = 0
+
+
+def _write_rooms(rooms, seq):
+    meta = {}
+    for room, messages in rooms.items():
+        meta[room] = _room_meta(room, messages)
+        _write_segment(meta[room]["file"], messages.values())
+    _write_manifest(meta, seq)
+    _remove_stale_segments(meta)
+
+
+def _remove_stale_segments(meta):
+    segment_dir = os.path.dirname(_segment_path("x"))
+    if not os.path.isdir(segment_dir):
+        return
+    live = {entry["file"] for entry in meta.values()}
+    for file_name in os.listdir(segment_dir):
+        if file_name not in live and not file_name.endswith(".tmp"):
+            os.remove(os.path.join(segment_dir, file_name))
+
+
+def _migrate_snapshot():
+    # One-shot upgrade of chat_rooms.json (plain or format 2) and any journal
+    # written against it into a manifest plus per-room segments.
+    seq = 0
+    rooms = {}
     if os.path.exists(SAVE_FILE):
         with open(SAVE_FILE, "r") as file:
             data = json.load(file)
-            for room in data.values():
-                for msg in room:
-                    if "reactions" in msg and isinstance(msg["reactions"], list):
-                        msg["reactions"] = {}
-            return data
-    return {}
+        if data.get("format") == 2:
+            seq = data["seq"]
+            data = data["rooms"]
+        rooms = {room: _index_messages(messages) for room, messages in data.items()}
+    records = _read_journal(_old_journal(), seq) + _read_journal(JOURNAL_FILE, seq)
+    _apply_all(rooms, records)
+    seq = max([seq] + [record["seq"] for record in records])
+    _write_rooms(rooms, seq)
+    _reset_journal()
+    return seq
+
+
+def load_manifest():
+    # Returns the room directory plus the journal records that are not yet
+    # folded into segments, grouped by room, without reading any segment.
+    global _seq
+    with _compact_lock, _lock:
+        if not os.path.exists(_manifest_path()):
+            _migrate_snapshot()
+        with open(_manifest_path(), "r") as file:
+            data = json.load(file)
+        meta, seq = data["rooms"], data["seq"]
+        records = _read_journal(_old_journal(), seq) + _read_journal(JOURNAL_FILE, seq)
+        _seq = max([_seq, seq] + [record["seq"] for record in records])
+    pending = {}
+    deleted = set()
+    for record in records:
+        room = record["room"]
+        if record["op"] == "create_room":
+            meta.setdefault(room, _new_meta(room, record.get("created")))
+        elif record["op"] == "delete_room":
+            meta.pop(room, None)
+            pending.pop(room, None)
+            deleted.add(room)
+        else:
+            _fold_meta(meta.setdefault(room, _new_meta(room)), record)
+            if record["op"] != "mark_read":
+                pending.setdefault(room, []).append(record)
+    for room in deleted & meta.keys():
+        # Re-created after a delete that no compaction has seen yet: the
+        # segment on disk still holds the deleted room's messages, and
+        # everything the new room has is in its pending records.
+        meta[room]["stale_segment"] = True
+    return meta, pending
+
+
+@metrics.timed("storage_load_segment")
+def load_segment(meta, room, records=()):
+    # Segments are only ever written from repaired records, so unlike the
+    # legacy snapshot they are read back as they are.
+    stored = [] if meta[room].get("stale_segment") else _read_segment(meta[room]["file"])
+    rooms = {room: {msg["id"]: msg for msg in stored}}
+    _apply_all(rooms, records)
+    return rooms.get(room, {})
+
+
+def load_rooms():
+    meta, pending = load_manifest()
+    return _list_rooms({room: load_segment(meta, room, pending.get(room, ())) for room in meta})
+
 
 def save_rooms(rooms):
-    with open(SAVE_FILE, "w") as file:
-        json.dump(rooms, file)
\ No newline at end of file
+    rooms = {room: _index_messages(messages) for room, messages in rooms.items()}
+    with _compact_lock, _lock:
+        _write_rooms(rooms, _seq)
+        _reset_journal()
+
+
+@metrics.timed("storage_compact")
+def _compact():
+    # Folds the rotated journal into the segments of the rooms it touched;
+    # the manifest is rewritten last, so it only ever points at whole segments.
+    with _compact_lock:
+        if not os.path.exists(_old_journal()):
+            return
+        with open(_manifest_path(), "r") as file:
+            data = json.load(file)
+        meta, seq = data["rooms"], data["seq"]
+        records = _read_journal(_old_journal(), seq)
+        touched = {}
+        for record in records:
+            room = record["room"]
+            if room not in touched and room in meta:
+                touched[room] = load_segment(meta, room)
+            if record["op"] == "delete_room":
+                meta.pop(room, None)
+            elif room not in meta:
+                meta[room] = _new_meta(room, record.get("created"))
+            if room in meta:
+                _fold_meta(meta[room], record)
+            _apply_all(touched, [record])
+        for room, messages in touched.items():
+            if room in meta:
+                meta[room] = _room_meta(room, messages, meta[room])
+                _write_segment(meta[room]["file"], messages.values())
+        _write_manifest(meta, max([seq] + [record["seq"] for record in records]))
+        _remove_stale_segments(meta)
+        os.remove(_old_journal())
+
+
+def compact():
+    # Folds a rotated journal into the segments now, waiting for a background
+    # compaction that is already running.
+    _compact()
+
+
+def _encode_record(op, room, fields):
+    global _seq
+    with _lock:
+        _seq += 1
+        return json.dumps(dict(fields, op=op, room=room, seq=_seq)) + "\n"
+
+
+def _write_records(lines):
+    global _journal, _pending
+    with _lock:
+        if _journal is None:
+            _journal = _open_journal()
+        data = "".join(lines)
+        _journal.write(data)
+        _journal.flush()
+        # Records are ASCII-only JSON, so characters are bytes.
+        metrics.count("bytes_persisted", len(data))
+        _pending += len(lines)
+        if _deferred or _pending < COMPACT_EVERY:
+            return
+        if not _rotate():
+            # A rotated journal is still waiting: compaction is running, or
+            # a crash or a failed run left it. Retry folding it in now and
+            # again every COMPACT_EVERY records until it is gone.
+            _pending = 0
+        _start_compaction()
+
+
+def _start_compaction():
+    # Called under _lock; at most one background compaction at a time.
+    global _compacting
+    if not _compacting:
+        _compacting = True
+        threading.Thread(target=_compact_in_background, daemon=True, name="journal-compaction").start()
+
+
+def _compact_in_background():
+    global _compacting
+    try:
+        _compact()
+    except Exception:
+        metrics.count("compaction_errors")
+        logger.exception("journal compaction failed; it is retried after more writes")
+    finally:
+        with _lock:
+            _compacting = False
+
+
+def _rotate():
+    # Called under _lock, so new records land in a fresh journal while the
+    # old one is folded into the segments. Returns whether it rotated.
+    global _pending
+    if not os.path.exists(JOURNAL_FILE) or os.path.exists(_old_journal()):
+        return False
+    _close_journal()
+    os.replace(JOURNAL_FILE, _old_journal())
+    _pending = 0
+    return True
+
+
+def _defer_compaction(step):
+    # Returns whether the last deferral just ended with a rotated journal
+    # for the caller to compact.
+    global _deferred
+    with _lock:
+        _deferred += step
+        return not _deferred and _pending >= COMPACT_EVERY and _rotate()
+
+
+class JournalWriter:
+    # Single owner of the journal file: mutations are encoded as they happen
+    # and written in batches once FLUSH_INTERVAL has passed since the first
+    # pending record, or as soon as FLUSH_BATCH records are waiting.
+    def __init__(self):
+        self.pending = []
+        self.ready = threading.Condition()
+        self.write_lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True, name="journal-writer").start()
+        atexit.register(self.flush)
+
+    def submit(self, op, room, **fields):
+        with self.ready:
+            self.pending.append(_encode_record(op, room, fields))
+            if len(self.pending) == 1 or len(self.pending) >= FLUSH_BATCH:
+                self.ready.notify()
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.pending:
+                    self.ready.wait()
+                deadline = time.monotonic() + FLUSH_INTERVAL
+                while len(self.pending) < FLUSH_BATCH and time.monotonic() < deadline:
+                    self.ready.wait(deadline - time.monotonic())
+            self.flush()
+
+    @metrics.timed("storage_journal_write")
+    def flush(self):
+        with self.write_lock:
+            with self.ready:
+                lines, self.pending = self.pending, []
+            if lines:
+                _write_records(lines)
+
+
+class JsonBackend:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.writer = JournalWriter()
+        # Only the manifest is read up front; a room's segment is loaded the
+        # first time something touches that room.
+        self.meta, self.pending = load_manifest()
+        if os.path.exists(_old_journal()):
+            # Rotated but never folded in before the last exit.
+            with _lock:
+                _start_compaction()
+        # Loaded rooms hold compact Message objects; dicts only exist on the
+        # way to and from disk.
+        self.rooms = {}
+        self.index = SearchIndex()
+        self.archive = archive.ColdArchive(os.path.join(DATA_DIR, "archive"))
+        # room -> clock value of its last send, edit or delete. Deleted rooms
+        # keep theirs, so any change shows up in the whole mapping.
+        self.versions = {}
+        self.clock = 0
+
+    def _room(self, room):
+        messages = self.rooms.get(room)
+        if messages is None and room in self.meta:
+            segment = load_segment(self.meta, room, self.pending.pop(room, ()))
+            messages = self.rooms[room] = {message_id: Message.from_dict(msg) for message_id, msg in segment.items()}
+            self.meta[room] = _room_meta(room, segment, self.meta[room])
+            for msg in messages.values():
+                self._index(room, msg)
+        return messages
+
+    def _index(self, room, msg):
+        if msg.message_type == "chat_message":
+            self.index.add(room, msg.id, msg.text, msg.user_name)
+
+    def room_names(self):
+        with self.lock:
+            return list(self.meta.keys())
+
+    def room_info(self, room):
+        with self.lock:
+            return dict(self.meta[room]) if room in self.meta else None
+
+    def has_room(self, room):
+        return room in self.meta
+
+    def room_versions(self):
+        with self.lock:
+            return dict(self.versions)
+
+    def _bump(self, room):
+        self.clock += 1
+        self.versions[room] = self.clock
+
+    def _summary(self, room):
+        entry = self.meta[room]
+        if entry.get("preview") is None and entry["count"] and room not in self.rooms:
+            # Its newest message was deleted before the last restart.
+            self._room(room)
+            entry = self.meta[room]
+        return {
+            "room": room,
+            "count": entry["count"],
+            "last_activity": entry["last_activity"],
+            "preview": dict(entry["preview"]) if entry.get("preview") else None,
+        }
+
+    def _entry(self, room, user_name):
+        entry = self._summary(room)
+        # Unread is the number of messages added since the user's marker; a
+        # deleted unread message still counts until the next mark_read.
+        meta = self.meta[room]
+        unread = meta.get("added", meta["count"]) - meta.get("reads", {}).get(user_name, 0)
+        entry["unread"] = max(0, min(unread, entry["count"]))
+        return entry
+
+    def room_entry(self, room, user_name):
+        with self.lock:
+            return self._entry(room, user_name) if room in self.meta else None
+
+    def room_summary(self, room):
+        # A directory entry without the reader-specific unread count.
+        with self.lock:
+            return self._summary(room) if room in self.meta else None
+
+    @metrics.timed("storage_directory")
+    def directory(self, user_name):
+        # Every room's directory entry, most recently active first, from the
+        # metadata alone: no segment is loaded.
+        with self.lock:
+            entries = [self._entry(room, user_name) for room in self.meta]
+        entries.sort(key=lambda entry: entry["last_activity"], reverse=True)
+        return entries
+
+    def mark_read(self, room, user_name):
+        with self.lock:
+            entry = self.meta.get(room)
+            if entry is None:
+                return
+            added = entry.get("added", entry["count"])
+            reads = entry.setdefault("reads", {})
+            if reads.get(user_name) != added:
+                reads[user_name] = added
+                self.writer.submit("mark_read", room, user_name=user_name, added=added)
+
+    @metrics.timed("storage_messages")
+    def messages(self, room, before=None, after=None, limit=None):
+        with self.lock:
+            return [(message_id, msg.copy()) for message_id, msg in self._page(room, before, after, limit)]
+
+    def _page(self, room, before, after, limit):
+        messages = self._room(room) or {}
+        hot = self._hot_page(messages.items(), before, after, limit)
+        anchored = (before if before is not None else after) in messages
+        return archive.page(self.archive, room, hot, before, after, limit, anchored)
+
+    def _hot_page(self, items, before, after, limit):
+        if before is None and after is None and limit is None:
+            return list(items)
+        # Walk from the newest end so recent pages cost O(limit) no matter
+        # how long the room history is.
+        newest_first = reversed(items)
+        if before is not None:
+            newest_first = itertools.dropwhile(lambda item: item[0] != before, newest_first)
+            next(newest_first, None)
+            return list(itertools.islice(newest_first, limit))[::-1]
+        if after is not None:
+            newer = list(itertools.takewhile(lambda item: item[0] != after, newest_first))
+            return newer[::-1][:limit]
+        return list(itertools.islice(newest_first, limit))[::-1]
+
+    @metrics.timed("storage_get_message")
+    def get_message(self, room, message_id):
+        with self.lock:
+            msg = (self._room(room) or {}).get(message_id)
+            return msg.copy() if msg is not None else self.archive.get(room, message_id)
+
+    @metrics.timed("storage_search")
+    def search(self, query, room=None, limit=None, include_archive=False):
+        with self.lock:
+            # Searching everywhere has to bring every room's segment in once.
+            rooms = [room] if room is not None else list(self.meta)
+            for name in rooms:
+                self._room(name)
+            hits = sorted(self.index.search(query, room), key=lambda hit: hit[1], reverse=True)
+            found = [self.rooms[r][message_id].copy() for r, message_id in hits[:limit]]
+        if include_archive:
+            found += self.archive.search(query, rooms, limit)
+            found.sort(key=lambda message: message.id, reverse=True)
+        return found[:limit]
+
+    @metrics.timed("storage_create_room")
+    def create_room(self, room):
+        with self.lock:
+            if room not in self.meta:
+                self.meta[room] = _new_meta(room)
+                self.rooms[room] = {}
+            self.writer.submit("create_room", room, created=self.meta[room]["last_activity"])
+
+    @metrics.timed("storage_delete_room")
+    def delete_room(self, room):
+        with self.lock:
+            self.meta.pop(room, None)
+            self.rooms.pop(room, None)
+            self.pending.pop(room, None)
+            self.index.remove_room(room)
+            self.archive.remove_room(room)
+            self._bump(room)
+            self.writer.submit("delete_room", room)
+
+    @metrics.timed("storage_add_message")
+    def add_message(self, room, message):
+        message = message.copy()
+        with self.lock:
+            if self._room(room) is None:
+                self.create_room(room)
+            self.rooms[room][message.id] = message
+            record = {"op": "add_message", "message": message.to_dict()}
+            _fold_meta(self.meta[room], record)
+            self._index(room, message)
+            self._bump(room)
+            self.writer.submit("add_message", room, message=record["message"])
+
+    @metrics.timed("storage_add_messages")
+    def add_messages(self, room, messages):
+        # Bulk insert for imports; messages whose id is already in the room are
+        # skipped, so re-running an import is harmless. Returns how many were added.
+        added = 0
+        with self.lock:
+            existing = self._room(room)
+            for message in messages:
+                if existing is None or message.id not in existing:
+                    self.add_message(room, message)
+                    existing = self.rooms[room]
+                    added += 1
+        return added
+
+    @contextlib.contextmanager
+    def bulk_import(self):
+        # An import journals every message, and compacting every
+        # COMPACT_EVERY records would rewrite each imported room's whole
+        # segment over and over. Compaction waits and runs once at the end.
+        _defer_compaction(1)
+        try:
+            yield
+        finally:
+            self.flush()
+            if _defer_compaction(-1):
+                _compact()
+
+    def iter_messages(self, room, after=None, batch=500):
+        # Oldest first, archived partitions before the hot segment. A room
+        # nobody has opened is read from its segment and not kept, so
+        # streaming every room holds one room at a time.
+        if after is None or self.archive.get(room, after) is not None:
+            for message in self.archive.iter_messages(room):
+                if after is None or message.id > after:
+                    yield message
+            after = None
+        with self.lock:
+            messages = self.rooms.get(room)
+            if messages is None:
+                if room not in self.meta:
+                    return
+                segment = load_segment(self.meta, room, self.pending.get(room, ()))
+                messages = {message_id: Message.from_dict(msg) for message_id, msg in segment.items()}
+            ids = list(messages)
+        start = ids.index(after) + 1 if after in messages else 0
+        for offset in range(start, len(ids), batch):
+            with self.lock:
+                chunk = [messages[i].copy() for i in ids[offset:offset + batch] if i in messages]
+            yield from chunk
+
+    @metrics.timed("storage_update_message")
+    def update_message(self, room, message_id, fields):
+        with self.lock:
+            msg = (self._room(room) or {}).get(message_id)
+            if msg is None:
+                self.archive.update(room, message_id, fields)
+                self._bump(room)
+                return
+            for field, value in fields.items():
+                setattr(msg, field, value)
+            if "text" in fields:
+                self._index(room, msg)
+                self._bump(room)
+            _fold_meta(self.meta[room], {"op": "update_message", "id": message_id, "fields": fields})
+            self.writer.submit("update_message", room, id=message_id, fields=fields)
+
+    @metrics.timed("storage_toggle_reaction")
+    def toggle_reaction(self, room, message_id, emoji, user_name):
+        # Returns whether the reaction was added, or None if the message is gone.
+        with self.lock:
+            msg = (self._room(room) or {}).get(message_id)
+            if msg is None:
+                return self.archive.change(room, message_id, lambda archived: archived.toggle_reaction(emoji, user_name))
+            added = msg.toggle_reaction(emoji, user_name)
+            self.writer.submit("set_reaction", room, id=message_id, emoji=emoji, user_name=user_name, added=added)
+            return added
+
+    @metrics.timed("storage_delete_message")
+    def delete_message(self, room, message_id):
+        with self.lock:
+            messages = self._room(room) or {}
+            if messages.pop(message_id, None) is None:
+                if self.archive.delete(room, message_id):
+                    self._bump(room)
+                return
+            self._bump(room)
+            entry = self.meta[room]
+            entry["count"] -= 1
+            if entry.get("preview") and entry["preview"]["id"] == message_id:
+                newest = next(reversed(messages.values()), None)
+                entry["preview"] = _preview(newest.to_dict()) if newest is not None else None
+            self.index.remove(room, message_id)
+            self.writer.submit("delete_message", room, id=message_id)
+
+    @metrics.timed("storage_retention")
+    def enforce_retention(self, days=archive.RETENTION_DAYS):
+        # Moves messages older than `days` into the cold archive, a room at a
+        # time. Rooms whose oldest message is recent are skipped from the
+        # metadata alone, so a pass costs nothing once the hot set is trimmed.
+        bound = archive.cutoff_id(days)
+        moved = 0
+        for room in self.room_names():
+            with self.lock:
+                entry = self.meta.get(room)
+                if entry is None:
+                    continue
+                # Manifests from before archiving lack "oldest"; those rooms
+                # are checked once and the result journaled.
+                known = "oldest" in entry
+                if known and (entry["oldest"] is None or entry["oldest"] >= bound):
+                    continue
+                messages = self.rooms.get(room)
+                if messages is None:
+                    segment = load_segment(self.meta, room, self.pending.get(room, ()))
+                    old = [Message.from_dict(msg) for message_id, msg in segment.items() if message_id < bound]
+                    remaining = [message_id for message_id in segment if message_id >= bound]
+                else:
+                    old = [msg for message_id, msg in messages.items() if message_id < bound]
+                    remaining = [message_id for message_id in messages if message_id >= bound]
+                if old:
+                    self.archive.add(room, old)
+                    if messages is not None:
+                        for msg in old:
+                            del messages[msg.id]
+                            self.index.remove(room, msg.id)
+                    self._bump(room)
+                record = {"op": "archive_messages", "room": room, "before": bound, "moved": len(old),
+                          "oldest": min(remaining, default=None)}
+                _fold_meta(entry, record)
+                if old or not known:
+                    if messages is None:
+                        self.pending.setdefault(room, []).append(record)
+                    self.writer.submit("archive_messages", room, before=bound, moved=len(old), oldest=record["oldest"])
+                moved += len(old)
+        return moved
+
+    @metrics.timed("storage_flush")
+    def flush(self):
+        self.writer.flush()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+_data_dir_lock = None
+
+
+def _claim_data_dir():
+    # The JSON files belong to one process: a second writer would interleave
+    # journal records and compactions. Several processes share rooms through
+    # the SQLite backend instead.
+    global _data_dir_lock
+    if fcntl is None or _data_dir_lock is not None:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    handle = open(os.path.join(DATA_DIR, ".lock"), "w")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        raise RuntimeError(
+            f"{DATA_DIR} is in use by another process; use CHAT_STORAGE=sqlite to share rooms between processes"
+        )
+    _data_dir_lock = handle
+
+
+def open_backend(kind=None):
+    # One backend per process: every session shares the same rooms and the
+    # same writer instead of loading a private copy.
+    kind = kind or os.environ.get("CHAT_STORAGE", "json")
+    with _backends_lock:
+        if kind not in _backends:
+            if kind == "json":
+                _claim_data_dir()
+                _backends[kind] = JsonBackend()
+            elif kind == "sqlite":
+                from sqlite_storage import SqliteBackend
+                _backends[kind] = SqliteBackend()
+            else:
+                raise ValueError(f"Unknown storage backend: {kind}")
+            archive.start_retention(_backends[kind])
+        return _backends[kind]
@@ -0,0 +1,208 @@
+import argparse
+import base64
+import json
+import os
+import sys
+from datetime import datetime
+
+from blobs import blob_path, is_image, make_thumbnails, put_bytes, put_file
+from ids import message_time, new_message_id
+from message import Message
+from storage import open_backend
+
+# Newline-delimited JSON, one record per line:
+#   {"type": "header", "format": 1}
+#   {"type": "room", "room": ...}
+#   {"type": "message", "room": ..., "message": {...}}
+# Attachment bytes are not inlined; they go to a blob directory next to the
+# file (FILE.blobs by default) laid out like the app's own blob store.
+FORMAT = 1
+BATCH = 500
+TAIL_CHUNK = 64 * 1024
+
+
+def parse_time(value):
+    # Epoch seconds or an ISO date/datetime.
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def in_range(message_id, since, until):
+    timestamp = message_time(message_id)
+    return (since is None or timestamp >= since) and (until is None or timestamp < until)
+
+
+def default_blob_dir(path):
+    if path == "-":
+        raise ValueError("--blobs is required when streaming through stdin/stdout")
+    return path + ".blobs"
+
+
+def last_record(path):
+    # The last complete record of an interrupted export. A torn final line is
+    # cut off so appending continues on a line boundary. Reads backwards from
+    # the end, so resuming does not depend on the size of the file.
+    with open(path, "rb+") as file:
+        position = file.seek(0, os.SEEK_END)
+        tail = b""
+        while position > 0:
+            step = min(TAIL_CHUNK, position)
+            position -= step
+            file.seek(position)
+            tail = file.read(step) + tail
+            end = tail.rfind(b"\n")
+            start = tail.rfind(b"\n", 0, end) if end != -1 else -1
+            if end == -1 or (start == -1 and position > 0):
+                continue
+            file.truncate(position + end + 1)
+            return json.loads(tail[start + 1:end])
+        file.truncate(0)
+    return None
+
+
+def export_message(msg, blob_dir):
+    attachment = msg.get("attachment")
+    if attachment:
+        source = blob_path(attachment["sha256"])
+        target = os.path.join(blob_dir, attachment["sha256"][:2], attachment["sha256"])
+        if not os.path.exists(target) and os.path.exists(source):
+            put_file(source, attachment["name"], directory=blob_dir)
+    elif msg.get("file_data"):
+        # Files from before the blob store were base64 inside the message;
+        # they leave as blobs and never come back inline.
+        msg["attachment"] = put_bytes(base64.b64decode(msg["file_data"]), msg.get("file_name") or "file", blob_dir)
+        msg["file_data"] = None
+    return msg
+
+
+def export_rooms(store, path, rooms=None, since=None, until=None, resume=False, blob_dir=None):
+    # Streams rooms in name order, oldest message first, so an interrupted
+    # run can pick up after the last record it wrote. Returns the number of
+    # messages written.
+    blob_dir = blob_dir or default_blob_dir(path)
+    names = sorted(rooms or store.room_names())
+    last_room = last_id = None
+    if resume and path != "-" and os.path.exists(path):
+        last = last_record(path)
+        if last is not None and last["type"] != "header":
+            last_room = last["room"]
+            last_id = last["message"]["id"] if last["type"] == "message" else None
+    out = sys.stdout if path == "-" else open(path, "a" if resume else "w", encoding="utf-8")
+    written = 0
+    try:
+        if out is sys.stdout or out.tell() == 0:
+            out.write(json.dumps({"type": "header", "format": FORMAT}) + "\n")
+        for room in names:
+            if not store.has_room(room) or (last_room is not None and room < last_room):
+                continue
+            if room != last_room:
+                out.write(json.dumps({"type": "room", "room": room}) + "\n")
+            after = last_id if room == last_room else None
+            for message in store.iter_messages(room, after=after, batch=BATCH):
+                if not in_range(message.id, since, until):
+                    continue
+                record = {"type": "message", "room": room, "message": export_message(message.to_dict(), blob_dir)}
+                out.write(json.dumps(record) + "\n")
+                written += 1
+                if written % BATCH == 0:
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return written
+
+
+def import_message(msg, blob_dir):
+    # Legacy records are repaired here, once, on their way in: list-shaped
+    # reactions, missing ids and inline base64 files.
+    if isinstance(msg.get("reactions"), list):
+        msg["reactions"] = {}
+    if not msg.get("id"):
+        msg["id"] = new_message_id()
+    attachment = msg.get("attachment")
+    if attachment:
+        source = os.path.join(blob_dir, attachment["sha256"][:2], attachment["sha256"])
+        if os.path.exists(source) and not os.path.exists(blob_path(attachment["sha256"])):
+            attachment.update(put_file(source, attachment["name"]))
+        if is_image(attachment) and os.path.exists(blob_path(attachment["sha256"])):
+            attachment.update(make_thumbnails(attachment["sha256"]))
+    elif msg.get("file_data"):
+        msg["attachment"] = put_bytes(base64.b64decode(msg["file_data"]), msg.get("file_name") or "file")
+        msg["file_data"] = None
+    return Message.from_dict(msg)
+
+
+def import_rooms(store, path, rooms=None, since=None, until=None, blob_dir=None):
+    # Messages already present (by id) are skipped, so an interrupted import
+    # is resumed by running it again. Returns the number of messages added.
+    blob_dir = blob_dir or default_blob_dir(path)
+    rooms = set(rooms) if rooms else None
+    source = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    added = 0
+    batch = []
+    batch_room = None
+    try:
+        with store.bulk_import():
+            for number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Most likely the torn end of an interrupted export.
+                    print(f"{path}:{number}: skipping a line that is not JSON", file=sys.stderr)
+                    continue
+                if record["type"] == "header":
+                    if record["format"] > FORMAT:
+                        raise ValueError(f"{path}: export format {record['format']} is newer than this version")
+                    continue
+                room = record["room"]
+                if rooms is not None and room not in rooms:
+                    continue
+                if batch and (room != batch_room or len(batch) >= BATCH):
+                    added += store.add_messages(batch_room, batch)
+                    batch = []
+                if record["type"] == "room":
+                    if not store.has_room(room):
+                        store.create_room(room)
+                elif record["type"] == "message" and in_range(record["message"].get("id"), since, until):
+                    batch_room = room
+                    batch.append(import_message(record["message"], blob_dir))
+            if batch:
+                added += store.add_messages(batch_room, batch)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+    store.flush()
+    return added
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream chat rooms to and from newline-delimited JSON.")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("file", help="NDJSON file, or - for stdout/stdin")
+    parser.add_argument("--room", action="append", help="only this room; repeat for several")
+    parser.add_argument("--since", help="only messages from this time on (epoch seconds or ISO date)")
+    parser.add_argument("--until", help="only messages before this time")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted export with the same filters")
+    parser.add_argument("--blobs", metavar="DIR", help="attachment directory (default FILE.blobs)")
+    parser.add_argument("--backend", choices=("json", "sqlite"), help="default: CHAT_STORAGE or json")
+    args = parser.parse_args(argv)
+
+    store = open_backend(args.backend)
+    since, until = parse_time(args.since), parse_time(args.until)
+    if args.command == "export":
+        count = export_rooms(store, args.file, args.room, since, until, args.resume, args.blobs)
+        print(f"exported {count} messages", file=sys.stderr)
+    else:
+        count = import_rooms(store, args.file, args.room, since, until, args.blobs)
+        print(f"imported {count} messages", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+import mimetypes
+import os
+import time
+import zlib
+
+import flet as ft
+import metrics
+from blobs import TIMELINE_THUMB, blob_url, format_size, is_image, thumb_url
+from ids import message_time
+from models import REACTION_EMOJIS, Message
+
+AVATAR_COLORS = [
+    ft.Colors.AMBER, ft.Colors.BLUE, ft.Colors.BROWN, ft.Colors.CYAN,
+    ft.Colors.GREEN, ft.Colors.INDIGO, ft.Colors.LIME, ft.Colors.ORANGE,
+    ft.Colors.PINK, ft.Colors.PURPLE, ft.Colors.RED, ft.Colors.TEAL, ft.Colors.YELLOW,
+]
+
+_avatars = {}
+
+
+def avatar_style(user_name: str):
+    # crc32 rather than hash() so a user keeps the same color across
+    # processes and restarts.
+    style = _avatars.get(user_name)
+    if style is None:
+        name = user_name or ""
+        color = AVATAR_COLORS[zlib.crc32(name.encode("utf-8")) % len(AVATAR_COLORS)]
+        style = _avatars[user_name] = (name[:1].capitalize(), color)
+    return style
+
+
+class MessageActions(ft.BottomSheet):
+    # One reaction picker and edit/delete menu per session, pointed at
+    # whichever message was tapped, instead of a menu and two buttons
+    # inside every rendered message.
+    def __init__(self, on_edit, on_delete, on_reaction):
+        self.on_edit = on_edit
+        self.on_delete = on_delete
+        self.on_reaction = on_reaction
+        self.target = None
+        super().__init__(
+            content=ft.Container(
+                content=ft.Column(
+                    [
+                        ft.Row([ft.TextButton(emoji, data=emoji, on_click=self.react) for emoji in REACTION_EMOJIS]),
+                        ft.Row(
+                            [
+                                ft.TextButton("Edit", icon=ft.Icons.EDIT, on_click=self.edit),
+                                ft.TextButton("Delete", icon=ft.Icons.DELETE, on_click=self.delete),
+                            ]
+                        ),
+                    ],
+                    tight=True,
+                ),
+                padding=10,
+            )
+        )
+
+    def show(self, message: Message):
+        self.target = message
+        self.open = True
+        self.update()
+
+    def dismiss(self):
+        self.open = False
+        self.update()
+        return self.target
+
+    def react(self, e):
+        self.on_reaction(self.dismiss(), e.control.data)
+
+    def edit(self, e):
+        self.on_edit(self.dismiss())
+
+    def delete(self, e):
+        self.on_delete(self.dismiss())
+
+
+class ImageViewer(ft.AlertDialog):
+    # One per session. The timeline only shows thumbnails; an original is
+    # fetched when this opens on it.
+    def __init__(self):
+        super().__init__(actions=[ft.TextButton("Close", on_click=self.close)])
+
+    def show(self, title: str, src=None, src_base64=None):
+        self.title = ft.Text(title)
+        self.content = ft.Image(src=src, src_base64=src_base64, fit=ft.ImageFit.CONTAIN)
+        self.open = True
+        self.update()
+
+    def close(self, e):
+        self.open = False
+        self.content = None
+        self.update()
+
+
+def file_badge(name: str, size: int, mime: str, url=None, on_click=None):
+    # Name, size and type only; the payload is fetched if the badge is clicked.
+    kind = os.path.splitext(name)[1][1:].upper() or mime
+    return ft.Container(
+        content=ft.Row(
+            [
+                ft.Icon(ft.Icons.IMAGE if mime.startswith("image/") else ft.Icons.INSERT_DRIVE_FILE, size=18),
+                ft.Text(name, color=ft.Colors.BLUE),
+                ft.Text(f"{format_size(size)} · {kind}", size=12, color=ft.Colors.GREY_600),
+            ],
+            tight=True,
+            spacing=6,
+        ),
+        url=url,
+        on_click=on_click,
+        bgcolor=ft.Colors.GREY_100,
+        border_radius=5,
+        padding=ft.padding.symmetric(horizontal=8, vertical=4),
+    )
+
+
+def search_result(hit, on_click):
+    # A ranked hit: its snippet with the matched words highlighted.
+    message = hit.message
+    spans = [
+        ft.TextSpan(text, ft.TextStyle(weight=ft.FontWeight.BOLD, bgcolor=ft.Colors.YELLOW_100) if highlighted else None)
+        for text, highlighted in hit.snippet
+    ]
+    return ft.ListTile(
+        title=ft.Text(spans=spans, max_lines=2),
+        subtitle=ft.Text(f"{message.user_name} in {message.room} · {activity_label(message_time(message.id))}", size=12),
+        on_click=lambda e: on_click(message),
+    )
+
+
+def activity_label(timestamp: float):
+    if not timestamp:
+        return ""
+    if time.time() - timestamp < 86400:
+        return time.strftime("%H:%M", time.localtime(timestamp))
+    return time.strftime("%d/%m", time.localtime(timestamp))
+
+
+class RoomRow(ft.Container):
+    # One sidebar entry. set_entry() patches it in place from a directory
+    # entry, so a new message only re-sends this row.
+    # Attributes are set before Container.__init__, which assigns every
+    # Control property (badge, tooltip, ...), so none may share those names.
+    def __init__(self, room: str, on_select, on_delete):
+        self.room = room
+        self.entry = None
+        self.last_activity = 0
+        self.name = ft.Text(room, max_lines=1, overflow=ft.TextOverflow.ELLIPSIS, expand=True)
+        self.time = ft.Text("", size=11, color=ft.Colors.GREY_600)
+        self.preview = ft.Text("", size=12, color=ft.Colors.GREY_600, max_lines=1, overflow=ft.TextOverflow.ELLIPSIS)
+        self.badge_count = ft.Text("", size=11, color=ft.Colors.WHITE)
+        self.unread_badge = ft.Container(
+            content=self.badge_count,
+            bgcolor=ft.Colors.BLUE,
+            border_radius=10,
+            padding=ft.padding.symmetric(horizontal=6, vertical=1),
+            visible=False,
+        )
+        super().__init__(
+            content=ft.Row(
+                [
+                    ft.Column([ft.Row([self.name, self.time]), self.preview], spacing=2, expand=True, tight=True),
+                    self.unread_badge,
+                    ft.IconButton(icon=ft.Icons.DELETE, tooltip="Delete room", on_click=lambda e: on_delete(room)),
+                ],
+                spacing=4,
+            ),
+            on_click=lambda e: on_select(room),
+            border_radius=5,
+            padding=ft.padding.only(left=8),
+        )
+
+    def set_entry(self, entry, active=False):
+        self.entry = entry
+        self.last_activity = entry["last_activity"]
+        unread = 0 if active else entry["unread"]
+        preview = entry["preview"]
+        self.name.weight = ft.FontWeight.BOLD if unread or active else None
+        self.time.value = activity_label(entry["last_activity"])
+        self.preview.value = f"{preview['user_name']}: {preview['text']}" if preview else ""
+        self.badge_count.value = str(unread) if unread < 100 else "99+"
+        self.unread_badge.visible = bool(unread)
+        self.bgcolor = ft.Colors.with_opacity(0.08, ft.Colors.BLUE) if active else None
+        return self
+
+
+class ChatMessage(ft.Row):
+    def __init__(self, message: Message, actions: MessageActions, on_reaction, current_user: str,
+                 highlight: bool = False, pending: bool = False, viewer: ImageViewer = None):
+        super().__init__()
+        self.opacity = 0.5 if pending else None
+        self.vertical_alignment = ft.CrossAxisAlignment.START
+        self.message = message
+        self.actions = actions
+        self.viewer = viewer
+        self.on_reaction = on_reaction
+        self.current_user = current_user
+        self.highlight = highlight
+        self.reaction_chips = {}
+        self.reactions_row = None
+
+        self.build_controls()
+
+    @metrics.timed("ui_build_controls")
+    def build_controls(self):
+        initials, color = avatar_style(self.message.user_name)
+        self.text_control = ft.Text(self.message.text, selectable=True)
+        self.body = ft.Column(
+            [
+                ft.Text(self.message.user_name, weight="bold"),
+                self.text_control,
+            ],
+            tight=True,
+            spacing=5,
+        )
+
+        file_control = self.attachment_control()
+        if file_control is not None:
+            self.body.controls.append(file_control)
+
+        for emoji in self.message.reactions:
+            self.set_chip(emoji)
+
+        self.controls = [
+            ft.CircleAvatar(
+                content=ft.Text(initials),
+                color=ft.Colors.WHITE,
+                bgcolor=color,
+            ),
+            ft.Container(
+                content=self.body,
+                bgcolor=ft.colors.AMBER_100 if self.highlight else None,
+                border=ft.border.all(2, ft.colors.AMBER_400) if self.highlight else None,
+                border_radius=5,
+                padding=5,
+                on_click=self.show_actions,
+                on_long_press=self.show_actions,
+            ),
+        ]
+
+    def set_chip(self, emoji: str):
+        # Creates, restyles or removes the chip for one emoji and returns the
+        # control that needs sending to the client.
+        count = self.message.reaction_count(emoji)
+        chip = self.reaction_chips.get(emoji)
+        if not count:
+            if chip is None:
+                return None
+            del self.reaction_chips[emoji]
+            self.reactions_row.controls.remove(chip)
+            return self.reactions_row
+        reacted = self.message.has_reacted(emoji, self.current_user)
+        style = ft.ButtonStyle(
+            color=ft.colors.BLUE if reacted else None,
+            bgcolor=ft.colors.BLUE_100 if reacted else ft.colors.GREY_200,
+            padding=ft.padding.symmetric(horizontal=8, vertical=4),
+        )
+        if chip is not None:
+            chip.text = f"{emoji} {count}"
+            chip.style = style
+            return chip
+        chip = self.reaction_chips[emoji] = ft.TextButton(
+            f"{emoji} {count}",
+            data=emoji,
+            style=style,
+            on_click=self.chip_clicked,
+        )
+        if self.reactions_row is None:
+            self.reactions_row = ft.Row(wrap=True, spacing=5)
+            self.body.controls.append(self.reactions_row)
+            self.reactions_row.controls.append(chip)
+            return self.body
+        self.reactions_row.controls.append(chip)
+        return self.reactions_row
+
+    def attachment_control(self):
+        attachment = self.message.attachment
+        if attachment:
+            if not is_image(attachment):
+                return file_badge(attachment["name"], attachment["size"], attachment["mime"],
+                                  url=blob_url(attachment["sha256"]))
+            thumbs = attachment.get("thumbs")
+            if thumbs:
+                size = next((size for size in thumbs if size >= TIMELINE_THUMB), thumbs[-1])
+                src = thumb_url(attachment["sha256"], size)
+            else:
+                # Uploaded without Pillow available: no thumbnails to show.
+                src = blob_url(attachment["sha256"])
+            return ft.Container(
+                content=ft.Image(src=src, width=300, height=200, fit=ft.ImageFit.CONTAIN),
+                on_click=self.open_image,
+            )
+        if self.message.file_data:
+            # Legacy inline attachments: the base64 payload only goes to the
+            # client when the image is opened.
+            name = self.message.file_name or "file"
+            mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            size = len(self.message.file_data) * 3 // 4
+            return file_badge(name, size, mime, on_click=self.open_image if mime.startswith("image/") else None)
+        return None
+
+    def open_image(self, e):
+        if self.viewer is None:
+            return
+        attachment = self.message.attachment
+        if attachment:
+            self.viewer.show(attachment["name"], src=blob_url(attachment["sha256"]))
+        else:
+            self.viewer.show(self.message.file_name, src_base64=self.message.file_data)
+
+    def show_actions(self, e):
+        self.actions.show(self.message)
+
+    def chip_clicked(self, e):
+        self.on_reaction(self.message, e.control.data)
+
+    def apply_reaction(self, emoji: str, user_name: str, added: bool):
+        if added:
+            self.message.add_reaction(emoji, user_name)
+        else:
+            self.message.remove_reaction(emoji, user_name)
+        return self.set_chip(emoji)
+
+    def set_text(self, text: str):
+        self.message.text = text
+        self.text_control.value = text
+        return self.text_control
+
+
+class LazyOverlay:
+    # An overlay control that is only built, and only sent to the client,
+    # the first time it is needed. Most sessions never open most dialogs.
+    def __init__(self, page, factory):
+        self.page = page
+        self.factory = factory
+        self.control = None
+
+    def get(self):
+        if self.control is None:
+            with metrics.span("ui_build_overlay"):
+                self.control = self.factory()
+            self.page.overlay.append(self.control)
+            self.page.update()
+        return self.control
+
+    def show(self, *args, **kwargs):
+        self.get().show(*args, **kwargs)
@@ -0,0 +1,14 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_WORKERS = 4
+
+# Storage, file and search work is blocking; running it here keeps the
+# session's event loop free to handle input while it completes.
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="chat-io")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+import storage
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    # The JSON store works relative to the current directory and keeps its
+    # journal handle and sequence number in module globals.
+    monkeypatch.chdir(tmp_path)
+    storage._close_journal()
+    monkeypatch.setattr(storage, "_seq", 0)
+    monkeypatch.setattr(storage, "_pending", 0)
+    monkeypatch.setattr(storage, "_compacting", False)
+    # Writers flush at exit too; flush them here, while the journal path
+    # still points into tmp_path.
+    stores = []
+    init = storage.JsonBackend.__init__
+    monkeypatch.setattr(storage.JsonBackend, "__init__", lambda self: init(self) or stores.append(self))
+    yield tmp_path
+    for store in stores:
+        store.flush()
+    wait_for_compaction()
+    storage._close_journal()
+
+
+def restart(store=None):
+    # What a new process sees: everything journaled so far, nothing in memory.
+    if store is not None:
+        store.flush()
+    storage._close_journal()
+    return storage.JsonBackend()
+
+
+def compact(store):
+    # Forces the journal rotation that COMPACT_EVERY records would trigger
+    # and folds it into the segments.
+    store.flush()
+    storage._close_journal()
+    storage.os.replace(storage.JOURNAL_FILE, storage._old_journal())
+    storage.compact()
+
+
+def wait_for_compaction(timeout=5):
+    deadline = time.monotonic() + timeout
+    while storage._compacting and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not storage._compacting
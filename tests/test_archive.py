@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import threading
+
+from archive import ColdArchive, start_retention
+from ids import new_message_id
+from message import Message
+
+
+def test_reads_return_copies(tmp_path):
+    cold = ColdArchive(str(tmp_path))
+    first, second = (Message("alice", text, "chat_message", "R") for text in ("one", "two"))
+    cold.add("R", [first, second])
+    for read in (cold.older("R", None, 10), cold.newer("R", "0", 10)):
+        for message in read:
+            message.text = "changed"
+            message.toggle_reaction("👍", "bob")
+    assert [message.text for message in cold.older("R", new_message_id(), 10)] == ["one", "two"]
+    assert not cold.get("R", first.id).reactions
+
+
+def archive_many(root, user, count):
+    cold = ColdArchive(root)
+    for number in range(count):
+        cold.add("R", [Message(user, str(number), "chat_message", "R")])
+
+
+def test_processes_sharing_an_archive_do_not_lose_writes(tmp_path):
+    workers = [
+        multiprocessing.get_context("fork").Process(target=archive_many, args=(str(tmp_path), user, 30))
+        for user in ("alice", "bob")
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(30)
+        assert worker.exitcode == 0
+    messages = list(ColdArchive(str(tmp_path)).iter_messages("R"))
+    assert len(messages) == 60
+    assert not [name for _, _, files in os.walk(tmp_path) for name in files if name.endswith(".tmp")]
+
+
+def test_retention_survives_a_failed_pass():
+    passes = threading.Semaphore(0)
+
+    class Store:
+        calls = 0
+
+        def enforce_retention(self, days):
+            self.calls += 1
+            passes.release()
+            if self.calls == 1:
+                raise OSError("database is locked")
+
+    start_retention(Store(), days=1, interval=0.01)
+    assert passes.acquire(timeout=2) and passes.acquire(timeout=2)
@@ -0,0 +1,51 @@
+import threading
+
+import events
+from backpressure import Outbox
+from message import Message
+
+
+def added(room):
+    return events.message_added(Message("alice", "hi", "chat_message", room))
+
+
+def test_failing_handler_does_not_stop_delivery():
+    delivered = []
+    done = threading.Event()
+
+    def on_event(event):
+        if event.room == "bad":
+            raise ValueError("control already removed")
+        delivered.append(event.room)
+        if event.room == "last":
+            done.set()
+
+    outbox = Outbox(on_event, lambda: None)
+    for room in ("first", "bad", "last"):
+        outbox.put(added(room))
+    assert done.wait(2)
+    outbox.close()
+    assert delivered == ["first", "last"]
+
+
+def test_coalesced_room_updates_add_up():
+    delivered = []
+    release = threading.Event()
+    done = threading.Event()
+
+    def on_event(event):
+        release.wait(2)
+        delivered.append(event)
+        if len(delivered) == 2:
+            done.set()
+
+    outbox = Outbox(on_event, lambda: None)
+    outbox.put(added("first"))  # holds the drain thread while the rest queue up
+    for count in (1, 2, 3):
+        outbox.put(events.room_updated("R", {"room": "R", "count": count}, added=1))
+    release.set()
+    assert done.wait(2)
+    outbox.close()
+    update = delivered[1]
+    assert update.fields["summary"]["count"] == 3
+    assert update.fields["added"] == 3
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import chat
+import events
+import storage
+from chat import ChatSession, DirectoryThrottle, LocalPubSub
+
+
+def connect(store, hub, name, room):
+    received = []
+    session = ChatSession(store, hub.client(), received.append, name)
+    session.open_room(room)
+    session.directory()
+    return session, received
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_directory_updates_come_from_the_event(data_dir, monkeypatch):
+    monkeypatch.setattr(chat, "directory_throttle", DirectoryThrottle(0.05))
+    store = storage.JsonBackend()
+    store.create_room("general")
+    store.create_room("random")
+    hub = LocalPubSub()
+    alice, _ = connect(store, hub, "alice", "general")
+    bob, bob_events = connect(store, hub, "bob", "random")
+
+    calls = []
+    for name in ("mark_read", "room_entry"):
+        method = getattr(store, name)
+        monkeypatch.setattr(store, name, lambda *args, name=name, method=method: calls.append(name) or method(*args))
+    for text in ("one", "two", "three"):
+        alice.send(alice.new_message(text))
+    assert calls == []
+
+    # The first update goes out at once, the other two as one trailing update.
+    def updates():
+        return [event for event in bob_events if event.kind == events.ROOM_UPDATED]
+    assert wait_for(lambda: len(updates()) == 2)
+    entries = [bob.directory_entry(event) for event in updates()]
+    assert [entry["unread"] for entry in entries] == [1, 3]
+    assert entries[-1]["preview"]["text"] == "three"
+    assert alice.directory_entry(updates()[-1])["unread"] == 0
+
+    bob.open_room("general")
+    assert {entry["room"]: entry["unread"] for entry in store.directory("bob")} == {"general": 0, "random": 0}
+
+
+def test_throttle_folds_a_burst_into_one_trailing_update():
+    throttle = DirectoryThrottle(0.05)
+    sent = []
+    trailing = threading.Event()
+
+    def send(added):
+        sent.append(added)
+        if len(sent) == 2:
+            trailing.set()
+
+    for _ in range(5):
+        throttle.submit("R", 1, send)
+    throttle.submit("R", 0, send)
+    assert sent == [1]
+    assert trailing.wait(2)
+    assert sent == [1, 4]
+    time.sleep(0.1)
+    assert sent == [1, 4]
@@ -0,0 +1,90 @@
+from message import Message
+from search import Query, SearchService
+
+import storage
+
+
+def setup_store(monkeypatch):
+    store = storage.JsonBackend()
+    calls = []
+    search = store.search
+    monkeypatch.setattr(store, "search", lambda *args, **kwargs: calls.append(args[0]) or search(*args, **kwargs))
+    return store, SearchService(store), calls
+
+
+def send(store, text, room="R", user="alice", attachment=None):
+    message = Message(user, text, "chat_message", room, attachment=attachment)
+    store.add_message(room, message)
+    return message.id
+
+
+def found(hits):
+    return sorted(hit.message.text for hit in hits)
+
+
+def test_cached_result_is_reused_until_the_room_changes(data_dir, monkeypatch):
+    store, service, calls = setup_store(monkeypatch)
+    apple = send(store, "apple pie")
+    send(store, "banana bread")
+    assert found(service.search("apple", room="R")) == ["apple pie"]
+    assert found(service.search("apple", room="R")) == ["apple pie"]
+    assert len(calls) == 1
+
+    crumble = send(store, "apple crumble")
+    assert found(service.search("apple", room="R")) == ["apple crumble", "apple pie"]
+    assert len(calls) == 2
+
+    store.update_message("R", apple, {"text": "cherry pie"})
+    assert found(service.search("apple", room="R")) == ["apple crumble"]
+    assert len(calls) == 3
+
+    store.delete_message("R", crumble)
+    assert found(service.search("apple", room="R")) == []
+    assert len(calls) == 4
+
+
+def test_changes_in_other_rooms_keep_a_room_scoped_result(data_dir, monkeypatch):
+    store, service, calls = setup_store(monkeypatch)
+    send(store, "apple pie")
+    service.search("apple", room="R")
+    send(store, "apple juice", room="other")
+    service.search("apple", room="R")
+    assert len(calls) == 1
+    assert found(service.search("apple")) == ["apple juice", "apple pie"]
+    assert len(calls) == 2
+
+
+def test_narrowed_query_is_answered_from_the_cached_base(data_dir, monkeypatch):
+    store, service, calls = setup_store(monkeypatch)
+    send(store, "apple pie")
+    send(store, "apple juice", user="bob")
+    send(store, "application form")
+    assert found(service.search("app", room="R")) == ["apple juice", "apple pie", "application form"]
+    assert found(service.search("apple", room="R")) == ["apple juice", "apple pie"]
+    assert found(service.search("apple pi", room="R")) == ["apple pie"]
+    assert found(service.search("app from:bob", room="R")) == ["apple juice"]
+    assert calls == ["app"]
+
+
+def test_refines():
+    assert Query("apple pie").refines(Query("app"))
+    assert Query("app from:bob").refines(Query("app"))
+    assert not Query("app").refines(Query("app from:bob"))
+    assert not Query("banana").refines(Query("app"))
+
+
+def test_filters(data_dir, monkeypatch):
+    store, service, _ = setup_store(monkeypatch)
+    attachment = {"sha256": "0" * 64, "name": "notes.txt", "size": 3, "mime": "text/plain"}
+    send(store, "plan for monday")
+    send(store, "plan from bob", user="bob")
+    send(store, "plan attached", attachment=attachment)
+    send(store, "plan elsewhere", room="other")
+    assert found(service.search("plan from:bob", room="R")) == ["plan from bob"]
+    assert found(service.search("from:bob", room="R")) == ["plan from bob"]
+    assert found(service.search("plan has:file", room="R")) == ["plan attached"]
+    assert found(service.search("has:file", room="R")) == ["plan attached"]
+    assert found(service.search("plan has:image", room="R")) == []
+    # room: overrides the scope the caller passed.
+    assert found(service.search("plan room:other", room="R")) == ["plan elsewhere"]
+    assert found(service.search("plan room:R")) == ["plan attached", "plan for monday", "plan from bob"]
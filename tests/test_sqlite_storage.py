@@ -0,0 +1,110 @@
+import json
+import sqlite3
+import time
+
+from message import Message
+from sqlite_storage import DB_FILE, SqliteBackend
+
+import storage
+
+ROOM = "R"
+
+
+def texts(store, room=ROOM, **page):
+    return [message.text for _, message in store.messages(room, **page)]
+
+
+def send(store, text, room=ROOM, days_ago=0):
+    message_id = None
+    if days_ago:
+        message_id = f"{time.time_ns() - int(days_ago * 86400e9):016x}00000000"
+    message = Message("alice", text, "chat_message", room, id=message_id)
+    store.add_message(room, message)
+    return message.id
+
+
+def test_migrates_legacy_snapshot(data_dir):
+    with open(storage.SAVE_FILE, "w") as file:
+        json.dump({ROOM: [
+            {"user_name": "alice", "text": "hello", "message_type": "chat_message", "reactions": []},
+            {"user_name": "bob", "text": "there", "message_type": "chat_message", "reactions": {"👍": ["alice"]}},
+        ]}, file)
+    store = SqliteBackend()
+    assert store.room_names() == [ROOM]
+    messages = [message for _, message in store.messages(ROOM)]
+    assert [message.text for message in messages] == ["hello", "there"]
+    assert all(message.id for message in messages)
+    assert messages[1].has_reacted("👍", "alice")
+    # Migration runs once, however often the database is opened.
+    store.db.close()
+    assert texts(SqliteBackend()) == ["hello", "there"]
+
+
+def test_adds_uids_to_old_databases(data_dir):
+    db = sqlite3.connect(DB_FILE)
+    db.executescript("""
+        CREATE TABLE rooms (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL UNIQUE);
+        CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room TEXT NOT NULL, user_name TEXT NOT NULL,
+            text TEXT NOT NULL, message_type TEXT NOT NULL, file_data TEXT, file_name TEXT);
+        INSERT INTO rooms(name) VALUES ('R');
+        INSERT INTO messages(room, user_name, text, message_type) VALUES ('R', 'alice', 'one', 'chat_message');
+        INSERT INTO messages(room, user_name, text, message_type) VALUES ('R', 'alice', 'two', 'chat_message');
+    """)
+    db.commit()
+    db.close()
+    store = SqliteBackend()
+    (first_id, first), (second_id, second) = store.messages(ROOM)
+    assert first_id and second_id and first_id < second_id
+    assert store.get_message(ROOM, second_id).text == "two"
+    assert store.room_entry(ROOM, "bob")["count"] == 2
+
+
+def test_edit_and_delete_reach_search(data_dir):
+    store = SqliteBackend()
+    apple = send(store, "apple pie")
+    banana = send(store, "banana bread")
+    assert [message.id for message in store.search("apple", ROOM)] == [apple]
+    store.update_message(ROOM, apple, {"text": "cherry pie"})
+    assert store.search("apple", ROOM) == []
+    assert [message.text for message in store.search("cherry", ROOM)] == ["cherry pie"]
+    store.delete_message(ROOM, banana)
+    assert store.search("banana", ROOM) == []
+    # Prefix match, and FTS syntax in the query is taken literally.
+    assert [message.id for message in store.search("cher", ROOM)] == [apple]
+    assert store.search('pie" OR "x', ROOM) == []
+
+
+def test_paging(data_dir):
+    store = SqliteBackend()
+    ids = [send(store, str(number)) for number in range(10)]
+    assert texts(store, limit=3) == ["7", "8", "9"]
+    assert texts(store, before=ids[7], limit=3) == ["4", "5", "6"]
+    assert texts(store, after=ids[2], limit=2) == ["3", "4"]
+    assert texts(store, before=ids[1], limit=5) == ["0"]
+    assert texts(store, after=ids[9], limit=5) == []
+
+
+def test_paging_across_the_archive(data_dir):
+    store = SqliteBackend()
+    old = [send(store, f"old {number}", days_ago=200 - number) for number in range(3)]
+    send(store, "new")
+    assert store.enforce_retention(90) == 3
+    assert store.room_entry(ROOM, "alice")["count"] == 1
+    assert texts(store, limit=3) == ["old 1", "old 2", "new"]
+    assert texts(store, before=old[2], limit=5) == ["old 0", "old 1"]
+    assert texts(store, after=old[0], limit=5) == ["old 1", "old 2", "new"]
+    assert store.get_message(ROOM, old[1]).text == "old 1"
+
+
+def test_directory_unread(data_dir):
+    store = SqliteBackend()
+    store.create_room("quiet")
+    send(store, "one")
+    store.mark_read(ROOM, "bob")
+    send(store, "two")
+    send(store, "three")
+    entries = {entry["room"]: entry for entry in store.directory("bob")}
+    assert entries[ROOM]["unread"] == 2 and entries[ROOM]["count"] == 3
+    assert entries[ROOM]["preview"]["text"] == "three"
+    assert entries["quiet"]["unread"] == 0
+    assert [entry["room"] for entry in store.directory("bob")][0] == ROOM
@@ -0,0 +1,135 @@
+from conftest import compact, restart, wait_for_compaction
+from message import Message
+
+import storage
+
+ROOM = "R"
+
+
+def texts(store, room=ROOM):
+    return [message.text for _, message in store.messages(room)]
+
+
+def send(store, text, room=ROOM):
+    store.add_message(room, Message("alice", text, "chat_message", room))
+
+
+def test_journal_replay(data_dir):
+    store = storage.JsonBackend()
+    store.create_room(ROOM)
+    send(store, "one")
+    send(store, "two")
+    store = restart(store)
+    assert texts(store) == ["one", "two"]
+
+
+def test_torn_journal_tail_is_cut_before_appending(data_dir):
+    store = storage.JsonBackend()
+    send(store, "one")
+    store = restart(store)
+    with open(storage.JOURNAL_FILE, "a") as journal:
+        journal.write('{"op": "add_message", "room": "R", "mess')
+    store = restart()
+    send(store, "two")
+    send(store, "three")
+    store = restart(store)
+    assert texts(store) == ["one", "two", "three"]
+
+
+def test_compaction_keeps_edits_and_deletes(data_dir):
+    store = storage.JsonBackend()
+    for text in ("one", "two", "three"):
+        send(store, text)
+    first, second, _ = [message_id for message_id, _ in store.messages(ROOM)]
+    store.update_message(ROOM, first, {"text": "one, edited"})
+    store.delete_message(ROOM, second)
+    compact(store)
+    assert not storage.os.path.exists(storage._old_journal())
+    send(store, "four")
+    store = restart(store)
+    assert texts(store) == ["one, edited", "three", "four"]
+    assert store.room_entry(ROOM, "alice")["count"] == 3
+
+
+def test_deleted_room_stays_deleted_after_restart(data_dir):
+    store = storage.JsonBackend()
+    send(store, "gone")
+    compact(store)
+    store.delete_room(ROOM)
+    store = restart(store)
+    assert not store.has_room(ROOM)
+    compact(store)
+    assert not storage.os.listdir(storage.os.path.join(storage.DATA_DIR, "rooms"))
+
+
+def test_recreated_room_does_not_read_old_segment(data_dir):
+    store = storage.JsonBackend()
+    send(store, "old secret")
+    compact(store)
+    store.delete_room(ROOM)
+    store.create_room(ROOM)
+    send(store, "new")
+    store = restart(store)
+    # Streaming reads the segment without loading the room.
+    assert [message.text for message in store.iter_messages(ROOM)] == ["new"]
+    assert texts(store) == ["new"]
+    compact(store)
+    store = restart(store)
+    assert texts(store) == ["new"]
+
+
+def test_bulk_import_compacts_once(data_dir, monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_EVERY", 10)
+    writes = []
+    write_segment = storage._write_segment
+    monkeypatch.setattr(storage, "_write_segment", lambda *args: writes.append(args[0]) or write_segment(*args))
+    store = storage.JsonBackend()
+    with store.bulk_import():
+        for start in range(0, 50, 10):
+            batch = [Message("alice", str(number), "chat_message", ROOM) for number in range(start, start + 10)]
+            store.add_messages(ROOM, batch)
+            store.flush()
+        assert not storage.os.path.exists(storage._old_journal())
+    assert len(writes) == 1
+    store = restart(store)
+    assert texts(store) == [str(number) for number in range(50)]
+
+
+def test_leftover_rotated_journal_is_compacted_on_start(data_dir):
+    store = storage.JsonBackend()
+    send(store, "one")
+    store.flush()
+    # A crash between rotating the journal and compacting it.
+    storage._close_journal()
+    storage.os.replace(storage.JOURNAL_FILE, storage._old_journal())
+    store = restart()
+    wait_for_compaction()
+    assert not storage.os.path.exists(storage._old_journal())
+    assert texts(store) == ["one"]
+
+
+def test_failed_compaction_is_retried(data_dir, monkeypatch):
+    monkeypatch.setattr(storage, "COMPACT_EVERY", 5)
+    failures = []
+    compact_now = storage._compact
+
+    def flaky():
+        if not failures:
+            failures.append(1)
+            raise OSError("disk full")
+        compact_now()
+
+    monkeypatch.setattr(storage, "_compact", flaky)
+    store = storage.JsonBackend()
+    for number in range(5):
+        send(store, str(number))
+    store.flush()
+    wait_for_compaction()
+    assert failures and storage.os.path.exists(storage._old_journal())
+    for number in range(5, 10):
+        send(store, str(number))
+    store.flush()
+    wait_for_compaction()
+    assert not storage.os.path.exists(storage._old_journal())
+    store = restart(store)
+    assert texts(store) == [str(number) for number in range(10)]
@@ -0,0 +1,19 @@
+import pytest
+
+ft = pytest.importorskip("flet")
+
+from widgets import RoomRow  # noqa: E402
+
+
+def entry(unread, preview=None):
+    return {"room": "general", "count": 5, "last_activity": 1.0, "preview": preview, "unread": unread}
+
+
+def test_room_row_set_entry():
+    row = RoomRow("general", on_select=lambda room: None, on_delete=lambda room: None)
+    assert row.set_entry(entry(3, {"id": "x", "user_name": "alice", "text": "hi"})) is row
+    assert row.unread_badge.visible and row.badge_count.value == "3"
+    assert row.preview.value == "alice: hi"
+    row.set_entry(entry(3), active=True)
+    assert not row.unread_badge.visible
+    assert row.name.weight == ft.FontWeight.BOLD